@@ -1,57 +1,194 @@
+import networkx as nx
 import numpy as np
+from bisect import bisect_left, bisect_right
 from collections import defaultdict
-from copy import copy
-from itertools import combinations
-from scipy.optimize import minimize
-from shapely.geometry import LineString, MultiPoint, Point
-from shapely.ops import nearest_points, polygonize, unary_union
+from concurrent.futures import ProcessPoolExecutor
+from heapq import heappop, heappush
+from itertools import repeat
+from math import ceil
+from scipy.optimize import linear_sum_assignment, minimize
+from scipy.spatial import Delaunay
+from shapely import __version__ as SHAPELY_VERSION
+from shapely.geometry import LineString, Point, Polygon, box
+from shapely.ops import polygonize, unary_union
+from shapely.prepared import prep
+from shapely.strtree import STRtree
 from sklearn.cluster import KMeans
 
 from .macros import get_geometries
 
+try:
+    from scipy.spatial import QhullError
+except ImportError:
+    from scipy.spatial.qhull import QhullError
 
-def get_source_polygons_with_connections(target_instances, maximum_distance):
+
+SHAPELY_MAJOR_VERSION = int(SHAPELY_VERSION.split('.')[0])
+CONVERSE_PREDICATE_BY_NAME = {
+    'contains': 'within',
+    'intersects': 'intersects',
+    'within': 'contains',
+}
+
+
+def get_source_polygons_with_connections(
+        target_instances, maximum_distance, process_count=None):
+    """Return polygons and the target instances connected to each polygon
+
+    Geometries cannot carry custom attributes in shapely 2, so the
+    connections come back in a list parallel to the polygons."""
     target_geometries = get_geometries(target_instances)
     # Convert target_geometries into target_polygons using maximum_distance
     target_polygons = [x.buffer(maximum_distance) for x in target_geometries]
     # Identify overlapping areas
-    sliced_polygons = get_disjoint_polygons(target_polygons)
-    for polygon in sliced_polygons:
-        candidates = []
-        for target_instance, target_polygon in zip(
-                target_instances, target_polygons):
-            if target_polygon.contains(polygon.centroid):
-                candidates.append(target_instance)
-        polygon.candidates = candidates
+    sliced_polygons = get_disjoint_polygons(target_polygons, process_count)
+    # Find the target_polygons that contain each centroid
+    candidate_indices_by_polygon = get_containing_indices(
+        target_polygons, [x.centroid for x in sliced_polygons])
     # Sort overlapping areas by overlap count
-    sorted_polygons = sorted(sliced_polygons, key=lambda x: -len(x.candidates))
+    sorted_pairs = sorted(zip(
+        sliced_polygons, candidate_indices_by_polygon),
+        key=lambda x: -len(x[1]))
     # Assign target_polygons to each sorted_polygon
-    target_instances = copy(target_instances)
-    social_polygons, lonely_polygons = [], []
-    for polygon in sorted_polygons:
+    assigned_indices = set()
+    social_pairs, lonely_pairs = [], []
+    for polygon, candidate_indices in sorted_pairs:
         connections = []
-        for target_instance in polygon.candidates:
-            try:
-                target_instances.remove(target_instance)
-            except ValueError:
+        for target_index in candidate_indices:
+            if target_index in assigned_indices:
                 continue
-            connections.append(target_instance)
+            assigned_indices.add(target_index)
+            connections.append(target_instances[target_index])
         connection_count = len(connections)
         if connection_count > 1:
-            social_polygons.append(polygon)
+            social_pairs.append((polygon, connections))
         elif connection_count == 1:
-            lonely_polygons.append(polygon)
-        polygon.connections = connections
-    return social_polygons + lonely_polygons
+            lonely_pairs.append((polygon, connections))
+    polygon_pairs = social_pairs + lonely_pairs
+    return [_[0] for _ in polygon_pairs], [_[1] for _ in polygon_pairs]
+
+
+def get_containing_indices(polygons, points):
+    'Return the sorted indices of the polygons that contain each point'
+    indices_by_point = [[] for _ in points]
+    for point_index, polygon_index in query_tree(polygons, points, 'within'):
+        indices_by_point[point_index].append(polygon_index)
+    return [sorted(_) for _ in indices_by_point]
+
 
+def query_tree(tree_geometries, query_geometries, predicate):
+    'Return (query_index, tree_index) pairs where query.predicate(tree) holds'
+    tree = STRtree(tree_geometries)
+    if SHAPELY_MAJOR_VERSION >= 2:
+        query_indices, tree_indices = tree.query(
+            query_geometries, predicate=predicate)
+        return list(zip(query_indices.tolist(), tree_indices.tolist()))
+    # Shapely 1.x returns the indexed geometries themselves
+    index_by_id = {id(x): index for index, x in enumerate(tree_geometries)}
+    # Prepare each tree geometry once and test the converse predicate
+    converse_predicate = CONVERSE_PREDICATE_BY_NAME[predicate]
+    prepared_geometry_by_index = {}
+    pairs = []
+    for query_index, query_geometry in enumerate(query_geometries):
+        for tree_geometry in tree.query(query_geometry):
+            tree_index = index_by_id[id(tree_geometry)]
+            try:
+                prepared_geometry = prepared_geometry_by_index[tree_index]
+            except KeyError:
+                prepared_geometry = prepared_geometry_by_index[
+                    tree_index] = prep(tree_geometry)
+            if getattr(prepared_geometry, converse_predicate)(query_geometry):
+                pairs.append((query_index, tree_index))
+    return pairs
+
+
+def get_point_xys(points):
+    'Return the x and y of each point in one array'
+    if SHAPELY_MAJOR_VERSION >= 2:
+        from shapely import get_coordinates
+        return get_coordinates(points)
+    return np.array([
+        _.coords[0][:2] for _ in points], dtype=float).reshape(-1, 2)
+
+
+def get_disjoint_polygons(overlapping_polygons, process_count=None):
+    """Split overlapping polygons into disjoint polygons
 
-def get_disjoint_polygons(overlapping_polygons):
-    'Split overlapping polygons into disjoint polygons'
+    Set process_count to polygonize each group of overlapping polygons
+    separately, in parallel if process_count > 1. The result contains the
+    same polygons in a different order."""
     rings = [LineString(list(
         x.exterior.coords)) for x in overlapping_polygons]
+    if process_count is None:
+        return polygonize_rings(rings)
+    components = get_overlap_components(overlapping_polygons)
+    ring_packs = [[rings[_] for _ in component] for component in components]
+    if process_count > 1 and len(ring_packs) > 1:
+        chunk_size = max(1, len(ring_packs) // (process_count * 4))
+        with ProcessPoolExecutor(max_workers=process_count) as executor:
+            polygon_packs = list(executor.map(
+                polygonize_rings, ring_packs, chunksize=chunk_size))
+    else:
+        polygon_packs = [polygonize_rings(_) for _ in ring_packs]
+    return restore_enclosed_holes(
+        overlapping_polygons, components, polygon_packs)
+
+
+def polygonize_rings(rings):
     return list(polygonize(unary_union(rings)))
 
 
+def get_overlap_components(polygons):
+    'Group polygon indices that overlap directly or through other polygons'
+    parents = list(range(len(polygons)))
+
+    def find(index):
+        while parents[index] != index:
+            parents[index] = parents[parents[index]]
+            index = parents[index]
+        return index
+
+    for index1, index2 in query_tree(polygons, polygons, 'intersects'):
+        root1, root2 = find(index1), find(index2)
+        if root1 != root2:
+            parents[max(root1, root2)] = min(root1, root2)
+    indices_by_root = defaultdict(list)
+    for index in range(len(polygons)):
+        indices_by_root[find(index)].append(index)
+    return list(indices_by_root.values())
+
+
+def restore_enclosed_holes(polygons, components, polygon_packs):
+    """Cut each component that sits inside an enclosed gap of another
+    component out of that gap, as polygonizing all rings at once does"""
+    faces, face_components = [], []
+    for component_index, polygon_pack in enumerate(polygon_packs):
+        faces.extend(polygon_pack)
+        face_components.extend([component_index] * len(polygon_pack))
+    points = [polygons[_[0]].representative_point() for _ in components]
+    enclosing_face_by_component = {}
+    for component_index, face_index in query_tree(faces, points, 'within'):
+        if face_components[face_index] == component_index:
+            continue
+        area = faces[face_index].area
+        if area < enclosing_face_by_component.get(
+                component_index, (np.inf, None))[0]:
+            enclosing_face_by_component[component_index] = area, face_index
+    components_by_face = defaultdict(list)
+    for component_index, (
+            area, face_index) in enclosing_face_by_component.items():
+        components_by_face[face_index].append(component_index)
+    for face_index, component_indices in components_by_face.items():
+        shells = []
+        for component_index in component_indices:
+            union = unary_union([
+                polygons[_] for _ in components[component_index]])
+            shells.extend(Polygon(_.exterior) for _ in getattr(
+                union, 'geoms', [union]))
+        faces[face_index] = faces[face_index].difference(unary_union(shells))
+    return faces
+
+
 def get_instance_clusters(instances, cluster_count):
     geometries = get_geometries(instances)
     points = [x.centroid for x in geometries]
@@ -63,25 +200,394 @@ def get_instance_clusters(instances, cluster_count):
     return list(instances_by_label.values())
 
 
+def get_capacitated_clusters(
+        instance_groups, maximum_count, maximum_distance, cluster_counts,
+        anchor_points=None, iteration_count=10, pull_count=4):
+    """Split each group of instances into clusters of at most maximum_count
+    instances that are all within maximum_distance of the cluster center.
+
+    Start from cluster_counts centers per group. Where instances fit nowhere,
+    pull the centers of their group toward its anchor point, which should be
+    within maximum_distance of every instance in the group, and open a new
+    center once that fails. Drop centers that end up empty. Return clusters,
+    center points and the change in cluster count from sum(cluster_counts)"""
+    xys, point_groups = [], []
+    for group_index, instances in enumerate(instance_groups):
+        for geometry in get_geometries(instances):
+            point = geometry.centroid
+            xys.append((point.x, point.y))
+            point_groups.append(group_index)
+    if not xys:
+        return [], [], -sum(cluster_counts)
+    xys, point_groups = np.array(xys, dtype=float), np.array(point_groups)
+    centers, center_groups = seed_cluster_centers(
+        xys, point_groups, cluster_counts, maximum_count)
+    # Move the seeds to the middle of their points as k-means would
+    for iteration_index in range(iteration_count):
+        assignments = assign_to_nearest(
+            xys, point_groups, centers, center_groups)
+        used_centers, assignments = np.unique(
+            assignments, return_inverse=True)
+        center_groups = center_groups[used_centers]
+        centers = np.column_stack([
+            np.bincount(assignments, weights=xys[:, 0]),
+            np.bincount(assignments, weights=xys[:, 1]),
+        ]) / np.bincount(assignments)[:, np.newaxis]
+    # Enforce both limits, moving centers only as far as their points allow
+    refinement_count = 0
+    if anchor_points is not None:
+        anchor_xys = np.array([(_.x, _.y) for _ in anchor_points], dtype=float)
+        pulled_counts = np.zeros(len(anchor_xys), dtype=int)
+    else:
+        anchor_xys = None
+    while True:
+        assignments = assign_with_capacity(
+            xys, point_groups, centers, center_groups,
+            maximum_count, maximum_distance)
+        unassigned_indices = np.flatnonzero(assignments < 0)
+        if len(unassigned_indices):
+            failed_groups = np.unique(point_groups[unassigned_indices])
+            if anchor_xys is not None:
+                # Halve the distance to the anchor, then jump onto it
+                pulled_groups = failed_groups[
+                    pulled_counts[failed_groups] <= pull_count]
+                fractions = np.zeros(len(anchor_xys))
+                fractions[pulled_groups] = np.where(
+                    pulled_counts[pulled_groups] < pull_count, 0.5, 1)
+                pulled_counts[pulled_groups] += 1
+                centers += fractions[center_groups][:, np.newaxis] * (
+                    anchor_xys[center_groups] - centers)
+                if len(pulled_groups):
+                    continue
+            # Open a center in each group at a point that fits nowhere
+            first_indices = np.unique(
+                point_groups[unassigned_indices], return_index=True)[1]
+            new_indices = unassigned_indices[first_indices]
+            centers = np.vstack([centers, xys[new_indices]])
+            center_groups = np.concatenate([
+                center_groups, point_groups[new_indices]])
+            continue
+        # Drop centers that lost all their points
+        used_centers, assignments = np.unique(
+            assignments, return_inverse=True)
+        centers = centers[used_centers]
+        center_groups = center_groups[used_centers]
+        refinement_count += 1
+        if refinement_count > iteration_count:
+            break
+        next_centers = move_within_reach(
+            xys, assignments, centers, get_geometric_medians(
+                xys, assignments, 1e-6, 1000), maximum_distance)
+        if np.allclose(next_centers, centers):
+            break
+        centers = next_centers
+    # Order clusters by group, then by position along the group
+    instances = [_ for group in instance_groups for _ in group]
+    center_order = np.lexsort((
+        centers[:, 1], centers[:, 0], center_groups))
+    cluster_by_center = {
+        center_index: [] for center_index in center_order.tolist()}
+    for instance, center_index in zip(instances, assignments.tolist()):
+        cluster_by_center[center_index].append(instance)
+    clusters = list(cluster_by_center.values())
+    center_points = [Point(centers[_]) for _ in center_order]
+    return clusters, center_points, len(clusters) - sum(cluster_counts)
+
+
+def seed_cluster_centers(xys, point_groups, cluster_counts, maximum_count):
+    'Pick spread out starting centers with farthest point traversal'
+    centers, center_groups = [], []
+    for group_index, cluster_count in enumerate(cluster_counts):
+        group_xys = xys[point_groups == group_index]
+        if not len(group_xys):
+            continue
+        cluster_count = max(cluster_count, int(ceil(
+            len(group_xys) / float(maximum_count))))
+        seed_xy = group_xys.mean(axis=0)
+        distances = np.full(len(group_xys), np.inf)
+        for cluster_index in range(min(cluster_count, len(group_xys))):
+            if cluster_index:
+                seed_xy = group_xys[distances.argmax()]
+            elif cluster_count > 1:
+                seed_xy = group_xys[np.hypot(*(
+                    group_xys - seed_xy).T).argmax()]
+            distances = np.minimum(distances, np.hypot(*(
+                group_xys - seed_xy).T))
+            centers.append(seed_xy)
+            center_groups.append(group_index)
+    return np.array(centers, dtype=float), np.array(center_groups)
+
+
+def get_group_pairs(xys, point_groups, centers, center_groups):
+    'Pair every point with every center of its group and measure distances'
+    center_order = np.argsort(center_groups, kind='stable')
+    group_count = max(point_groups.max(), center_groups.max()) + 1
+    center_counts = np.bincount(center_groups, minlength=group_count)
+    center_starts = np.concatenate([[0], np.cumsum(center_counts)[:-1]])
+    pair_counts = center_counts[point_groups]
+    pair_points = np.repeat(np.arange(len(xys)), pair_counts)
+    pair_offsets = np.arange(len(pair_points)) - np.repeat(
+        np.cumsum(pair_counts) - pair_counts, pair_counts)
+    pair_centers = center_order[
+        center_starts[point_groups[pair_points]] + pair_offsets]
+    pair_deltas = xys[pair_points] - centers[pair_centers]
+    pair_distances = np.hypot(pair_deltas[:, 0], pair_deltas[:, 1])
+    return pair_points, pair_centers, pair_distances
+
+
+def assign_to_nearest(xys, point_groups, centers, center_groups):
+    'Assign each point to the nearest center of its group'
+    pair_points, pair_centers, pair_distances = get_group_pairs(
+        xys, point_groups, centers, center_groups)
+    pair_order = np.lexsort((pair_distances, pair_points))
+    is_nearest = np.concatenate([
+        [True], np.diff(pair_points[pair_order]) > 0])
+    return pair_centers[pair_order[is_nearest]]
+
+
+def assign_with_capacity(
+        xys, point_groups, centers, center_groups, maximum_count,
+        maximum_distance):
+    """Assign points to centers of their group so that no center gets more
+    than maximum_count points and no point is beyond maximum_distance.
+    Leave as few points as possible at -1, then minimize total distance"""
+    assignments = np.full(len(xys), -1)
+    group_count = max(point_groups.max(), center_groups.max()) + 1
+    for point_indices, center_indices in zip(
+            split_by_group(point_groups, group_count),
+            split_by_group(center_groups, group_count)):
+        if not len(point_indices) or not len(center_indices):
+            continue
+        # Give each center one column per point it can take
+        slot_centers = np.repeat(center_indices, maximum_count)
+        deltas = xys[point_indices][:, np.newaxis] - centers[slot_centers]
+        distances = np.hypot(deltas[..., 0], deltas[..., 1])
+        is_far = distances > maximum_distance
+        penalty = maximum_distance * len(point_indices) + 1
+        rows, columns = linear_sum_assignment(
+            np.where(is_far, penalty, distances))
+        is_near = ~is_far[rows, columns]
+        assignments[point_indices[rows[is_near]]] = slot_centers[
+            columns[is_near]]
+    return assignments
+
+
+def split_by_group(groups, group_count):
+    'Return the indices of each group in order'
+    group_sizes = np.bincount(groups, minlength=group_count)
+    return np.split(
+        np.argsort(groups, kind='stable'), np.cumsum(group_sizes)[:-1])
+
+
+def move_within_reach(
+        xys, labels, centers, target_centers, maximum_distance,
+        iteration_count=30):
+    """Move each center toward its target as far as every point of its label
+    stays within maximum_distance, assuming they are within reach now"""
+    directions = target_centers - centers
+
+    def get_maximum_distances(fractions):
+        moved_centers = centers + fractions[:, np.newaxis] * directions
+        deltas = xys - moved_centers[labels]
+        maximum_distances = np.zeros(len(centers))
+        np.maximum.at(maximum_distances, labels, np.hypot(*deltas.T))
+        return maximum_distances
+
+    # Bisect the fraction of the way that can be taken
+    lows, highs = np.zeros(len(centers)), np.ones(len(centers))
+    is_reachable = get_maximum_distances(highs) <= maximum_distance
+    for iteration_index in range(iteration_count):
+        middles = (lows + highs) / 2
+        is_near = get_maximum_distances(middles) <= maximum_distance
+        lows = np.where(is_near, middles, lows)
+        highs = np.where(is_near, highs, middles)
+    fractions = np.where(is_reachable, 1, lows)
+    return centers + fractions[:, np.newaxis] * directions
+
+
 def place_store(geometries):
     'Return the point that minimizes the sum of distances to each geometry'
+    return place_stores([geometries])[0]
+
+
+def place_stores(
+        geometry_groups, tolerance_in_meters=1e-6,
+        maximum_iteration_count=1000):
+    'Place a store for each group of geometries in one batched computation'
+    stores = [None] * len(geometry_groups)
+    point_group_indices, xys, labels = [], [], []
+    for group_index, geometries in enumerate(geometry_groups):
+        if all(_.geom_type == 'Point' for _ in geometries):
+            labels.extend([len(point_group_indices)] * len(geometries))
+            xys.extend((_.x, _.y) for _ in geometries)
+            point_group_indices.append(group_index)
+        else:
+            # Distances to lines and polygons need the general optimizer
+            stores[group_index] = minimize_distance_sum(geometries)
+    if point_group_indices:
+        medians = get_geometric_medians(
+            np.array(xys, dtype=float), np.array(labels),
+            tolerance_in_meters, maximum_iteration_count)
+        for group_index, median_xy in zip(point_group_indices, medians):
+            stores[group_index] = Point(median_xy)
+    return stores
+
+
+def minimize_distance_sum(geometries):
     def sum_distances(xy):
         return sum(Point(xy).distance(g) for g in geometries)
     xy = geometries[0].centroid.coords[0]
     return Point(minimize(sum_distances, xy, method='L-BFGS-B').x)
 
 
+def get_geometric_medians(
+        xys, labels, tolerance_in_meters, maximum_iteration_count):
+    'Run Weiszfeld iterations for every label group at the same time'
+    # https://doi.org/10.1073/pnas.97.4.1423 (Vardi and Zhang)
+    group_count = labels.max() + 1
+
+    def sum_by_group(group_labels, values):
+        return np.bincount(group_labels, weights=values, minlength=group_count)
+
+    point_counts = sum_by_group(labels, np.ones(len(labels)))
+    medians = np.column_stack([
+        sum_by_group(labels, xys[:, 0]),
+        sum_by_group(labels, xys[:, 1])]) / point_counts[:, np.newaxis]
+    is_active = np.ones(group_count, dtype=bool)
+    for iteration_index in range(maximum_iteration_count):
+        # Only groups that have not converged are updated
+        rows = is_active[labels]
+        active_labels, active_xys = labels[rows], xys[rows]
+        deltas = active_xys - medians[active_labels]
+        distances = np.hypot(deltas[:, 0], deltas[:, 1])
+        is_coincident = distances <= tolerance_in_meters
+        weights = np.where(is_coincident, 0, 1 / np.where(
+            is_coincident, 1, distances))
+        weight_sums = sum_by_group(active_labels, weights)
+        has_weight = weight_sums > 0
+        weighted_means = np.column_stack([
+            sum_by_group(active_labels, weights * active_xys[:, 0]),
+            sum_by_group(active_labels, weights * active_xys[:, 1]),
+        ]) / np.where(has_weight, weight_sums, 1)[:, np.newaxis]
+        # Step off a data point only if that lowers the distance sum
+        pulls = np.column_stack([
+            sum_by_group(active_labels, weights * deltas[:, 0]),
+            sum_by_group(active_labels, weights * deltas[:, 1])])
+        pull_sizes = np.hypot(pulls[:, 0], pulls[:, 1])
+        coincident_counts = sum_by_group(active_labels, is_coincident)
+        stays = np.where(pull_sizes > 0, np.minimum(1, coincident_counts / (
+            np.where(pull_sizes > 0, pull_sizes, 1))), 1)[:, np.newaxis]
+        next_medians = np.where(
+            has_weight[:, np.newaxis],
+            (1 - stays) * weighted_means + stays * medians, medians)
+        shifts = np.hypot(*(next_medians - medians).T)
+        medians = next_medians
+        is_active &= shifts > tolerance_in_meters
+        if not is_active.any():
+            break
+    return medians
+
+
+def get_neighbor_pairs(xys):
+    """Return index pairs for the edges of the Delaunay triangulation, which
+    contain every edge of the Euclidean minimum spanning tree"""
+    xys = np.array(xys, dtype=float).reshape(len(xys), -1)[:, :2]
+    if len(xys) < 2:
+        return []
+    try:
+        triangulation = Delaunay(xys)
+    except QhullError:
+        # Points on one line connect to their neighbors along the line
+        order = np.lexsort((xys[:, 1], xys[:, 0])).tolist()
+        return list(zip(order, order[1:]))
+    simplices = triangulation.simplices
+    pairs = np.vstack([
+        simplices[:, [0, 1]], simplices[:, [1, 2]], simplices[:, [0, 2]],
+        # Points left out as duplicates connect to their nearest vertex
+        triangulation.coplanar[:, [0, 2]]])
+    pairs = np.unique(np.sort(pairs, axis=1), axis=0)
+    return [tuple(_) for _ in pairs.tolist()]
+
+
+def get_steiner_tree_edges(graph, terminal_nodes, weight):
+    """Approximate a minimum Steiner tree with Mehlhorn's algorithm, which
+    weighs no more than a minimum spanning tree over shortest paths"""
+    # https://doi.org/10.1016/0020-0190(88)90066-X
+    terminal_nodes = list(dict.fromkeys(terminal_nodes))
+    # Grow shortest paths from every terminal at once
+    distance_by_node = {_: 0 for _ in terminal_nodes}
+    terminal_by_node = {_: _ for _ in terminal_nodes}
+    previous_by_node = {}
+    heap = [(0, index, _) for index, _ in enumerate(terminal_nodes)]
+    push_count = len(heap)
+    visited_nodes = set()
+    while heap:
+        distance, push_index, node = heappop(heap)
+        if node in visited_nodes:
+            continue
+        visited_nodes.add(node)
+        for neighbor_node, d in graph[node].items():
+            neighbor_distance = distance + d[weight]
+            if neighbor_distance < distance_by_node.get(neighbor_node, np.inf):
+                distance_by_node[neighbor_node] = neighbor_distance
+                terminal_by_node[neighbor_node] = terminal_by_node[node]
+                previous_by_node[neighbor_node] = node
+                heappush(heap, (neighbor_distance, push_count, neighbor_node))
+                push_count += 1
+    # Join the regions of neighboring terminals through their cheapest edge
+    terminal_graph = nx.Graph()
+    terminal_graph.add_nodes_from(terminal_nodes)
+    for node1, node2, d in graph.edges(data=True):
+        terminal1 = terminal_by_node.get(node1)
+        terminal2 = terminal_by_node.get(node2)
+        if terminal1 is None or terminal2 is None or terminal1 == terminal2:
+            continue
+        distance = distance_by_node[node1] + d[weight] + distance_by_node[
+            node2]
+        if distance < terminal_graph.get_edge_data(
+                terminal1, terminal2, {weight: np.inf})[weight]:
+            terminal_graph.add_edge(
+                terminal1, terminal2, bridge=(node1, node2),
+                **{weight: distance})
+    # Expand the spanning tree of terminals into paths through the graph
+    path_edges = set()
+    for terminal1, terminal2, d in nx.minimum_spanning_tree(
+            terminal_graph, weight=weight).edges(data=True):
+        node1, node2 = d['bridge']
+        path_edges.add((node1, node2))
+        for node in node1, node2:
+            while node in previous_by_node:
+                path_edges.add((previous_by_node[node], node))
+                node = previous_by_node[node]
+    tree_graph = nx.Graph(nx.minimum_spanning_tree(
+        graph.edge_subgraph(path_edges), weight=weight))
+    # Prune branches that end without a terminal
+    terminal_node_set = set(terminal_nodes)
+    leaf_nodes = [_ for _ in tree_graph if tree_graph.degree(
+        _) == 1 and _ not in terminal_node_set]
+    while leaf_nodes:
+        node = leaf_nodes.pop()
+        neighbor_nodes = list(tree_graph[node])
+        tree_graph.remove_node(node)
+        for neighbor_node in neighbor_nodes:
+            if tree_graph.degree(
+                    neighbor_node) == 1 and neighbor_node not in (
+                    terminal_node_set):
+                leaf_nodes.append(neighbor_node)
+    return list(tree_graph.edges())
+
+
 def compute_angle(a_xy, b_xy, c_xy):
+    'Return the angle at b in degrees, for one point each or for arrays'
     # https://stackoverflow.com/a/31735642/192092
-    b_xy = np.array(b_xy)
-    angle1 = np.arctan2(*(a_xy - b_xy)[::-1])
-    angle2 = np.arctan2(*(c_xy - b_xy)[::-1])
-    angle_in_degrees = np.rad2deg(angle1 - angle2)
-    if angle_in_degrees < 0:
-        angle_in_degrees *= -1
-    if angle_in_degrees > 180:
-        angle_in_degrees = 360 - angle_in_degrees
-    return angle_in_degrees
+    a_xy, b_xy, c_xy = np.asarray(a_xy), np.asarray(b_xy), np.asarray(c_xy)
+    angle1 = np.arctan2(a_xy[..., 1] - b_xy[..., 1], a_xy[..., 0] - b_xy[
+        ..., 0])
+    angle2 = np.arctan2(c_xy[..., 1] - b_xy[..., 1], c_xy[..., 0] - b_xy[
+        ..., 0])
+    angle_in_degrees = np.abs(np.rad2deg(angle1 - angle2))
+    return np.where(
+        angle_in_degrees > 180, 360 - angle_in_degrees, angle_in_degrees)[()]
 
 
 def get_line_segments(line_geometries):
@@ -93,17 +599,50 @@ def get_line_segments(line_geometries):
     return line_segments
 
 
-def get_link_segments(line_geometries, link_line_maximum_length_in_meters):
+def get_link_segments(
+        line_geometries, link_line_maximum_length_in_meters,
+        process_count=None):
+    """Link each pair of lines that come within the maximum length without
+    touching by joining their nearest vertices
+
+    Set process_count > 1 to measure candidate pairs in parallel"""
+    d = link_line_maximum_length_in_meters
+    # Only lines that reach into the widened bounds of a line can be linked
+    search_boxes = []
+    for line_geometry in line_geometries:
+        min_x, min_y, max_x, max_y = line_geometry.bounds
+        search_boxes.append(box(min_x - d, min_y - d, max_x + d, max_y + d))
+    line_pairs = [(
+        line_geometries[index1], line_geometries[index2],
+    ) for index1, index2 in sorted(query_tree(
+        line_geometries, search_boxes, 'intersects')) if index1 < index2]
+    if process_count is not None and process_count > 1 and line_pairs:
+        chunk_size = max(1, len(line_pairs) // (process_count * 4))
+        line_pair_packs = [line_pairs[_:_ + chunk_size] for _ in range(
+            0, len(line_pairs), chunk_size)]
+        with ProcessPoolExecutor(max_workers=process_count) as executor:
+            link_segment_packs = list(executor.map(
+                link_line_pairs, line_pair_packs, repeat(d)))
+        return [_ for pack in link_segment_packs for _ in pack]
+    return link_line_pairs(line_pairs, d)
+
+
+def link_line_pairs(line_pairs, link_line_maximum_length_in_meters):
     link_segments = []
-    for line_geometry1, line_geometry2 in combinations(line_geometries, 2):
+    for line_geometry1, line_geometry2 in line_pairs:
         distance = line_geometry1.distance(line_geometry2)
         if distance > link_line_maximum_length_in_meters:
             continue
         if distance == 0:
             continue
-        link_segments.append(LineString(nearest_points(
-            MultiPoint(line_geometry1.coords),
-            MultiPoint(line_geometry2.coords))))
+        # Compare every vertex of one line with every vertex of the other
+        coords1, coords2 = line_geometry1.coords, line_geometry2.coords
+        deltas = np.array(coords1)[:, np.newaxis, :2] - np.array(
+            coords2)[np.newaxis, :, :2]
+        index1, index2 = np.unravel_index(np.hypot(
+            deltas[..., 0], deltas[..., 1]).argmin(), deltas.shape[:2])
+        link_segments.append(LineString([
+            coords1[int(index1)], coords2[int(index2)]]))
     return link_segments
 
 
@@ -118,6 +657,97 @@ def get_nearest_geometry(target_geometry, source_geometries):
     return nearest_geometry
 
 
+def get_nearest_indices(tree_geometries, query_geometries):
+    'Return the indices of the tree geometries nearest to each query geometry'
+    if not tree_geometries:
+        return [[] for _ in query_geometries]
+    tree = STRtree(tree_geometries)
+    if SHAPELY_MAJOR_VERSION >= 2:
+        query_indices, tree_indices = tree.query_nearest(
+            query_geometries, all_matches=True)
+        indices_by_query = [[] for _ in query_geometries]
+        for query_index, tree_index in zip(
+                query_indices.tolist(), tree_indices.tolist()):
+            indices_by_query[query_index].append(tree_index)
+        return indices_by_query
+    # Shapely 1.x has a slow nearest, so search growing boxes instead
+    index_by_id = {id(x): index for index, x in enumerate(tree_geometries)}
+    indices_by_query = []
+    for query_geometry in query_geometries:
+        min_x, min_y, max_x, max_y = query_geometry.bounds
+        d = 1
+        while True:
+            geometries = tree.query(box(
+                min_x - d, min_y - d, max_x + d, max_y + d))
+            distances = [query_geometry.distance(x) for x in geometries]
+            # Every geometry closer than d lies inside the box
+            if distances and min(distances) < d:
+                break
+            d *= 2
+        nearest_distance = min(distances)
+        indices_by_query.append(sorted(
+            index_by_id[id(x)] for x, distance in zip(
+                geometries, distances) if distance <= nearest_distance))
+    return indices_by_query
+
+
+class LineSegmentStore(object):
+    """Split line segments where points attach with get_t_segments, giving
+    the same pieces as scanning a list with get_nearest_geometry would"""
+
+    def __init__(self, line_segments):
+        self.line_segments = list(line_segments)
+        # Keep the pieces of each segment sorted by where they start on it,
+        # numbered in the order a list would hold them
+        self.starts_by_index = [[0.0] for _ in self.line_segments]
+        self.pieces_by_index = [[(order, x)] for order, x in enumerate(
+            self.line_segments)]
+        self.piece_count = len(self.line_segments)
+
+    def attach(self, point):
+        'Split the nearest piece and return the segment from point to it'
+        return self.attach_all([point])[0]
+
+    def attach_all(self, points):
+        'Attach points in order with one spatial index query for all'
+        return [self.split(point, segment_indices) for (
+            point, segment_indices,
+        ) in zip(points, get_nearest_indices(self.line_segments, points))]
+
+    def split(self, point, segment_indices):
+        candidates = []
+        for segment_index in segment_indices:
+            starts = self.starts_by_index[segment_index]
+            pieces = self.pieces_by_index[segment_index]
+            start = self.line_segments[segment_index].project(point)
+            # Look two pieces beyond any that start there, since splitting
+            # moves points along the segment by rounding errors
+            for piece_index in range(
+                    max(0, bisect_left(starts, start) - 2),
+                    min(len(pieces), bisect_right(starts, start) + 2)):
+                order, piece = pieces[piece_index]
+                candidates.append((
+                    point.distance(piece), order, segment_index,
+                    piece_index))
+        order, segment_index, piece_index = min(candidates)[1:]
+        starts = self.starts_by_index[segment_index]
+        pieces = self.pieces_by_index[segment_index]
+        path_segment, piece1, piece2 = get_t_segments(
+            point, pieces[piece_index][1])
+        pieces[piece_index] = self.piece_count, piece1
+        pieces.insert(piece_index + 1, (self.piece_count + 1, piece2))
+        starts.insert(piece_index + 1, self.line_segments[
+            segment_index].project(Point(piece2.coords[0])))
+        self.piece_count += 2
+        return path_segment
+
+    def get_line_segments(self):
+        'Return the pieces in the order a list would hold them'
+        return [piece for order, piece in sorted((
+            _ for pieces in self.pieces_by_index for _ in pieces),
+            key=lambda x: x[0])]
+
+
 def get_t_segments(point, line_segment):
     t_point_xyz = point.coords[0]
 
@@ -0,0 +1,385 @@
+import networkx as nx
+import numpy as np
+from array import array
+from itertools import chain
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components, dijkstra
+from shapely.geometry import LineString
+
+
+class CompactGraph(object):
+    """Undirected graph that interns node coordinates as integers and keeps
+    edges in arrays, with shortest paths from scipy.sparse.csgraph
+
+    Fill it with add_edge like a networkx Graph; an edge added twice keeps
+    its place and takes the new attributes, as in networkx. Only path_type,
+    geometry and cost are kept, and geometries only when they are not the
+    straight line between their nodes"""
+
+    def __init__(self):
+        self.node_xys = []
+        self.index_by_node_xy = {}
+        self.edge_index_by_node_pair = {}
+        self.edge_nodes1 = array('l')
+        self.edge_nodes2 = array('l')
+        # Store path types as positions in a list to keep their objects
+        self.path_type_values = []
+        self.path_types = array('b')
+        self.costs = array('d')
+        self.geometry_by_edge_index = {}
+        self._matrix = None
+
+    @classmethod
+    def from_networkx(Class, graph):
+        g = Class()
+        for node1_xy, node2_xy, d in graph.edges(data=True):
+            g.add_edge(node1_xy, node2_xy, **d)
+        return g
+
+    def to_networkx(self):
+        graph = nx.Graph()
+        graph.add_nodes_from(self.node_xys)
+        for edge_index in range(self.number_of_edges()):
+            graph.add_edge(
+                self.node_xys[self.edge_nodes1[edge_index]],
+                self.node_xys[self.edge_nodes2[edge_index]],
+                **self.get_edge_attributes(edge_index))
+        return graph
+
+    def __contains__(self, node_xy):
+        return node_xy in self.index_by_node_xy
+
+    def __len__(self):
+        return len(self.node_xys)
+
+    def number_of_edges(self):
+        return len(self.edge_nodes1)
+
+    def get_node_index(self, node_xy):
+        'Return the integer for node_xy, adding the node if it is new'
+        node_index = self.index_by_node_xy.get(node_xy)
+        if node_index is None:
+            node_index = self.index_by_node_xy[node_xy] = len(self.node_xys)
+            self.node_xys.append(node_xy)
+        return node_index
+
+    def add_edge(
+            self, node1_xy, node2_xy, path_type=None, geometry=None,
+            cost=np.nan, **attributes):
+        node1_index = self.get_node_index(node1_xy)
+        node2_index = self.get_node_index(node2_xy)
+        node_pair = min(node1_index, node2_index), max(
+            node1_index, node2_index)
+        edge_index = self.edge_index_by_node_pair.get(node_pair)
+        if edge_index is None:
+            edge_index = self.edge_index_by_node_pair[
+                node_pair] = self.number_of_edges()
+            self.edge_nodes1.append(node1_index)
+            self.edge_nodes2.append(node2_index)
+            self.path_types.append(-1)
+            self.costs.append(np.nan)
+        if path_type is None:
+            self.path_types[edge_index] = -1
+        else:
+            if path_type not in self.path_type_values:
+                self.path_type_values.append(path_type)
+            self.path_types[edge_index] = self.path_type_values.index(
+                path_type)
+        self.costs[edge_index] = cost
+        self.geometry_by_edge_index.pop(edge_index, None)
+        if geometry is not None and list(geometry.coords) != [
+                self.node_xys[self.edge_nodes1[edge_index]],
+                self.node_xys[self.edge_nodes2[edge_index]]]:
+            self.geometry_by_edge_index[edge_index] = geometry
+        self._matrix = None
+
+    def get_geometry(self, edge_index):
+        geometry = self.geometry_by_edge_index.get(edge_index)
+        if geometry is None:
+            geometry = LineString([
+                self.node_xys[self.edge_nodes1[edge_index]],
+                self.node_xys[self.edge_nodes2[edge_index]]])
+        return geometry
+
+    def get_edge_attributes(self, edge_index):
+        path_type = self.path_types[edge_index]
+        d = {
+            'path_type': None if path_type < 0 else self.path_type_values[
+                path_type],
+            'geometry': self.get_geometry(edge_index),
+        }
+        if not np.isnan(self.costs[edge_index]):
+            d['cost'] = self.costs[edge_index]
+        return d
+
+    def get_edge_data(self, node1_xy, node2_xy, default=None):
+        'Return a new dictionary of edge attributes, like networkx does'
+        node1_index = self.index_by_node_xy.get(node1_xy)
+        node2_index = self.index_by_node_xy.get(node2_xy)
+        if node1_index is None or node2_index is None:
+            return default
+        edge_index = self.edge_index_by_node_pair.get((
+            min(node1_index, node2_index), max(node1_index, node2_index)))
+        if edge_index is None:
+            return default
+        return self.get_edge_attributes(edge_index)
+
+    def set_costs(self, cost_per_meter_by_path_type):
+        'Set the cost of each edge from its path type and length'
+        path_types = np.array(self.path_types)
+        lengths = self.get_lengths()
+        costs = np.full(len(path_types), np.nan)
+        for index, path_type in enumerate(self.path_type_values):
+            if path_type not in cost_per_meter_by_path_type:
+                continue
+            is_type = path_types == index
+            costs[is_type] = cost_per_meter_by_path_type[
+                path_type] * lengths[is_type]
+        if np.isnan(costs).any():
+            raise KeyError('cost_per_meter is missing for a path_type')
+        self.costs = array('d', costs.tolist())
+        self._matrix = None
+
+    def get_neighbor_xys(self, node_xys):
+        """Return the neighbor count of each node, or -1 if it is missing,
+        and the neighbors of all nodes in one array, in networkx order"""
+        nodes1 = np.array(self.edge_nodes1, dtype=int)
+        nodes2 = np.array(self.edge_nodes2, dtype=int)
+        edge_indices = np.arange(len(nodes1))
+        # A node meets its neighbors in the order their edges were added
+        is_loop = nodes1 == nodes2
+        sources = np.concatenate([nodes1, nodes2[~is_loop]])
+        targets = np.concatenate([nodes2, nodes1[~is_loop]])
+        entry_order = np.lexsort((np.concatenate([
+            edge_indices, edge_indices[~is_loop]]), sources))
+        starts = np.searchsorted(sources[entry_order], np.arange(len(
+            self.node_xys) + 1))
+        all_node_xys = get_xy_array(self.node_xys)
+        return gather_neighbor_xys(
+            starts, all_node_xys[targets[entry_order]],
+            get_xy_indices(all_node_xys, node_xys))
+
+    def get_lengths(self):
+        node_xys = np.array([
+            _[:2] for _ in self.node_xys], dtype=float).reshape(-1, 2)
+        deltas = node_xys[np.array(self.edge_nodes1, dtype=int)] - node_xys[
+            np.array(self.edge_nodes2, dtype=int)]
+        lengths = np.hypot(deltas[:, 0], deltas[:, 1])
+        for edge_index, geometry in self.geometry_by_edge_index.items():
+            lengths[edge_index] = geometry.length
+        return lengths
+
+    @property
+    def matrix(self):
+        'Symmetric CSR matrix of edge costs, where explicit zeros are edges'
+        if self._matrix is None:
+            nodes1 = np.array(self.edge_nodes1, dtype=int)
+            nodes2 = np.array(self.edge_nodes2, dtype=int)
+            # Self loops never shorten a path
+            is_loop = nodes1 == nodes2
+            nodes1, nodes2 = nodes1[~is_loop], nodes2[~is_loop]
+            costs = np.array(self.costs)[~is_loop]
+            node_count = len(self.node_xys)
+            self._matrix = csr_matrix((
+                np.concatenate([costs, costs]), (
+                    np.concatenate([nodes1, nodes2]),
+                    np.concatenate([nodes2, nodes1]))),
+                shape=(node_count, node_count))
+        return self._matrix
+
+    def get_nearest_xys(self, source_xys, target_xys, target_counts):
+        """Rank target_xys by path cost from each source_xy, then by
+        position, and return the first target_counts of them per source,
+        leaving out targets that no path reaches"""
+        node_count = len(self.node_xys)
+        source_indices = np.array([
+            self.index_by_node_xy[_] for _ in source_xys], dtype=int)
+        is_target = np.zeros(node_count, dtype=bool)
+        is_target[[self.index_by_node_xy[_] for _ in target_xys if (
+            _ in self.index_by_node_xy)]] = True
+        # Expect no more targets than the component of each source holds
+        component_count, labels = connected_components(
+            self.matrix, directed=False)
+        target_counts = np.minimum(target_counts, np.bincount(
+            labels[is_target], minlength=component_count)[
+            labels[source_indices]])
+        distances = np.full((len(source_indices), node_count), np.inf)
+        costs = np.array(self.costs, dtype=float)
+        # Search all sources at once within a cost limit that covers the
+        # nearest nodes, and widen it only for sources still short
+        maximum_cost = costs.max() if len(costs) else 0
+        limit = max(target_counts.max(initial=0), 1) * maximum_cost
+        row_indices = np.flatnonzero(target_counts > 0)
+        while len(row_indices):
+            if limit >= costs.sum():
+                limit = np.inf
+            distances[row_indices] = dijkstra(
+                self.matrix, indices=source_indices[row_indices],
+                limit=limit).reshape(len(row_indices), node_count)
+            found_counts = (np.isfinite(
+                distances[row_indices]) & is_target).sum(axis=1)
+            row_indices = row_indices[
+                found_counts < target_counts[row_indices]]
+            if np.isinf(limit):
+                break
+            limit *= 2
+        coordinates = np.array(
+            self.node_xys, dtype=float).reshape(node_count, -1)
+        nearest_xys = []
+        for row_distances, target_count in zip(distances, target_counts):
+            node_indices = np.flatnonzero(
+                is_target & np.isfinite(row_distances))
+            node_distances = row_distances[node_indices]
+            # Keep the nearest targets and those tied with the last of them
+            if 0 < target_count < len(node_indices):
+                last_distance = node_distances[np.argpartition(
+                    node_distances, target_count - 1)[target_count - 1]]
+                is_near = node_distances <= last_distance
+                node_indices = node_indices[is_near]
+                node_distances = node_distances[is_near]
+            node_order = np.lexsort(tuple(
+                coordinates[node_indices].T[::-1]) + (node_distances,))
+            nearest_xys.append([self.node_xys[_] for _ in node_indices[
+                node_order[:target_count]].tolist()])
+        return nearest_xys
+
+    def get_shortest_paths(self, source_xy, target_xys):
+        'Return (node_xys, cost) for the cheapest path to each target'
+        distances, predecessors = dijkstra(
+            self.matrix, indices=self.index_by_node_xy[source_xy],
+            return_predecessors=True)
+        paths = []
+        for target_xy in target_xys:
+            node_index = self.index_by_node_xy[target_xy]
+            if np.isinf(distances[node_index]):
+                raise nx.NetworkXNoPath('%s is not reachable from %s' % (
+                    target_xy, source_xy))
+            node_indices = [node_index]
+            while predecessors[node_index] >= 0:
+                node_index = predecessors[node_index]
+                node_indices.append(node_index)
+            paths.append((
+                [self.node_xys[_] for _ in reversed(node_indices)],
+                distances[node_indices[0]]))
+        return paths
+
+    def get_steiner_tree_edges(self, terminal_xys):
+        """Approximate a minimum Steiner tree with Mehlhorn's algorithm like
+        get_steiner_tree_edges in algorithms, using array operations"""
+        terminal_indices = list(dict.fromkeys(
+            self.index_by_node_xy[_] for _ in terminal_xys))
+        distances, predecessors, sources = dijkstra(
+            self.matrix, indices=terminal_indices, min_only=True,
+            return_predecessors=True)
+        nodes1 = np.array(self.edge_nodes1, dtype=int)
+        nodes2 = np.array(self.edge_nodes2, dtype=int)
+        sources1, sources2 = sources[nodes1], sources[nodes2]
+        is_bridge = (sources1 >= 0) & (sources2 >= 0) & (
+            sources1 != sources2)
+        bridge_indices = np.flatnonzero(is_bridge)
+        bridge_costs = distances[nodes1] + np.array(
+            self.costs) + distances[nodes2]
+        # Join neighboring terminals through their cheapest bridge
+        bridge_order = bridge_indices[np.argsort(
+            bridge_costs[bridge_indices], kind='stable')]
+        path_edge_indices = set()
+        for edge_index in get_spanning_edge_indices(
+                sources1[bridge_order], sources2[bridge_order]):
+            edge_index = bridge_order[edge_index]
+            path_edge_indices.add(edge_index)
+            for node_index in nodes1[edge_index], nodes2[edge_index]:
+                while predecessors[node_index] >= 0:
+                    previous_index = predecessors[node_index]
+                    path_edge_indices.add(self.edge_index_by_node_pair[(
+                        min(node_index, previous_index),
+                        max(node_index, previous_index))])
+                    node_index = previous_index
+        # Span the paths again and prune branches without a terminal
+        path_edge_indices = np.array(sorted(path_edge_indices), dtype=int)
+        path_edge_indices = path_edge_indices[np.argsort(np.array(
+            self.costs)[path_edge_indices], kind='stable')]
+        tree_edge_indices = path_edge_indices[get_spanning_edge_indices(
+            nodes1[path_edge_indices], nodes2[path_edge_indices])]
+        neighbor_sets = {}
+        for edge_index in tree_edge_indices:
+            node1_index, node2_index = nodes1[edge_index], nodes2[edge_index]
+            neighbor_sets.setdefault(node1_index, set()).add(node2_index)
+            neighbor_sets.setdefault(node2_index, set()).add(node1_index)
+        terminal_index_set = set(terminal_indices)
+        leaf_indices = [_ for _, neighbor_indices in neighbor_sets.items(
+        ) if len(neighbor_indices) == 1 and _ not in terminal_index_set]
+        while leaf_indices:
+            node_index = leaf_indices.pop()
+            for neighbor_index in neighbor_sets.pop(node_index):
+                neighbor_indices = neighbor_sets[neighbor_index]
+                neighbor_indices.discard(node_index)
+                if len(neighbor_indices) == 1 and (
+                        neighbor_index not in terminal_index_set):
+                    leaf_indices.append(neighbor_index)
+        return [(
+            self.node_xys[nodes1[_]], self.node_xys[nodes2[_]],
+        ) for _ in tree_edge_indices if nodes1[_] in neighbor_sets and (
+            nodes2[_] in neighbor_sets)]
+
+
+def get_xy_array(node_xys):
+    'Return the x and y of each xy or xyz tuple in one array'
+    node_xys = iter(node_xys)
+    first_xy = next(node_xys, ())
+    coordinates = np.fromiter(chain(
+        first_xy, chain.from_iterable(node_xys)), dtype=float)
+    return coordinates.reshape(-1, max(len(first_xy), 2))[:, :2]
+
+
+def get_xy_indices(xys, query_xys):
+    'Return the row of xys equal to each row of query_xys, or -1 if none is'
+    # View each row as one complex number to sort and search rows exactly
+    keys, query_keys = [np.ascontiguousarray(
+        _, dtype=float).reshape(-1, 2).view(complex).ravel() for _ in (
+        xys, query_xys)]
+    if not len(keys):
+        return np.full(len(query_keys), -1)
+    key_order = np.argsort(keys)
+    indices = key_order[np.minimum(np.searchsorted(
+        keys[key_order], query_keys), len(keys) - 1)]
+    return np.where(keys[indices] == query_keys, indices, -1)
+
+
+def gather_neighbor_xys(starts, neighbor_xys, node_indices):
+    """Return the neighbor count of each node index, or -1 if the index is
+    negative, and the neighbors of all of them in one array, where node i
+    has neighbors neighbor_xys[starts[i]:starts[i + 1]]"""
+    starts = np.asarray(starts)
+    node_indices = np.asarray(node_indices, dtype=int).reshape(-1)
+    is_found = node_indices >= 0
+    found_indices = node_indices[is_found]
+    found_counts = starts[found_indices + 1] - starts[found_indices]
+    neighbor_counts = np.full(len(node_indices), -1)
+    neighbor_counts[is_found] = found_counts
+    entry_offsets = np.arange(found_counts.sum()) - np.repeat(
+        np.cumsum(found_counts) - found_counts, found_counts)
+    entry_indices = np.repeat(
+        starts[found_indices], found_counts) + entry_offsets
+    return neighbor_counts, np.asarray(
+        neighbor_xys, dtype=float).reshape(-1, 2)[entry_indices]
+
+
+def get_spanning_edge_indices(nodes1, nodes2):
+    'Return the edges that Kruskal keeps, given edges sorted by cost'
+    parents = {}
+
+    def find(node):
+        parents.setdefault(node, node)
+        while parents[node] != node:
+            parents[node] = parents[parents[node]]
+            node = parents[node]
+        return node
+
+    edge_indices = []
+    for edge_index, (node1, node2) in enumerate(zip(
+            nodes1.tolist(), nodes2.tolist())):
+        root1, root2 = find(node1), find(node2)
+        if root1 != root2:
+            parents[max(root1, root2)] = min(root1, root2)
+            edge_indices.append(edge_index)
+    return edge_indices
@@ -1,8 +1,8 @@
 import networkx as nx
 import numpy as np
 from collections import defaultdict
-from copy import copy
-from itertools import combinations
+from heapq import heapify, heappop, heappush
+from itertools import chain, combinations
 from math import ceil
 from networkx.algorithms.shortest_paths import (
     shortest_path, shortest_path_length)
@@ -12,9 +12,12 @@ from scipy.spatial import KDTree
 from shapely.geometry import LineString, Point
 
 from .algorithms import (
-    compute_angle, get_instance_clusters, get_line_segments, get_link_segments,
-    get_nearest_geometry, get_source_polygons_with_connections, get_t_segments,
-    place_store)
+    LineSegmentStore, compute_angle, get_capacitated_clusters,
+    get_line_segments, get_link_segments, get_neighbor_pairs,
+    get_point_xys, get_source_polygons_with_connections,
+    get_steiner_tree_edges, place_store, place_stores)
+from .graphs import (
+    CompactGraph, gather_neighbor_xys, get_xy_array, get_xy_indices)
 from .macros import get_geometries, get_other_endpoint_xy
 from .models import Battery, PathType, Pole
 
@@ -22,20 +25,23 @@ from .models import Battery, PathType, Pole
 def place_drop_poles(
         customers,
         drop_line_maximum_length_in_meters,
-        drop_line_maximum_count_per_pole):
-    drop_pole_polygons = get_source_polygons_with_connections(
+        drop_line_maximum_count_per_pole,
+        log=None):
+    drop_pole_polygons, customer_packs = get_source_polygons_with_connections(
         customers, drop_line_maximum_length_in_meters)
-    drop_poles = []
-    for polygon in drop_pole_polygons:
-        pole_count = estimate_drop_pole_count(
-            polygon, drop_line_maximum_count_per_pole)
-        if pole_count > 1:
-            clusters = get_instance_clusters(
-                polygon.connections, cluster_count=pole_count)
-            for customers in clusters:
-                drop_poles.append(make_drop_pole(customers))
-        else:
-            drop_poles.append(make_drop_pole(polygon.connections))
+    pole_counts = [estimate_drop_pole_count(
+        _, drop_line_maximum_count_per_pole) for _ in customer_packs]
+    customer_groups, pole_points, extra_pole_count = get_capacitated_clusters(
+        customer_packs,
+        drop_line_maximum_count_per_pole,
+        drop_line_maximum_length_in_meters,
+        pole_counts,
+        # Each polygon centroid was found within reach of its connections
+        [_.centroid for _ in drop_pole_polygons])
+    if log is not None:
+        log['extra_drop_pole_count'] = extra_pole_count
+    drop_poles = [make_drop_pole(customers, pole_point) for (
+        customers, pole_point) in zip(customer_groups, pole_points)]
     for index, pole in enumerate(drop_poles):
         pole.id = 'drop%s' % index
         for customer in pole._connected_customers:
@@ -46,28 +52,31 @@ def place_drop_poles(
 
 
 def estimate_drop_pole_count(
-        drop_pole_polygon, drop_line_maximum_count_per_pole):
-    connection_count = len(drop_pole_polygon.connections)
+        connections, drop_line_maximum_count_per_pole):
+    connection_count = len(connections)
     if not connection_count:
         return 1
     return ceil(connection_count / float(
         drop_line_maximum_count_per_pole))
 
 
-def make_drop_pole(customers):
-    pole_point = place_store(get_geometries(customers))
+def make_drop_pole(customers, pole_point=None):
+    if pole_point is None:
+        pole_point = place_store(get_geometries(customers))
     pole = Pole(geometry=pole_point)
     pole._connected_customers = customers
     return pole
 
 
-def place_distribution_graph_without_roads(drop_poles):
-    g = nx.Graph()
-    # Make paths connecting drop poles to each other
-    for pole1, pole2 in combinations(drop_poles, 2):
+def place_distribution_graph_without_roads(drop_poles, graph=None):
+    g = nx.Graph() if graph is None else graph
+    # Make paths connecting drop poles to their neighbors, which is enough
+    # to keep the minimum spanning tree of the complete graph
+    pole_xyzs = [_.geometry.coords[0] for _ in drop_poles]
+    for index1, index2 in get_neighbor_pairs(pole_xyzs):
         add_edge_from_line_segment(g, LineString([
-            pole1.geometry.coords[0],
-            pole2.geometry.coords[0]]), PathType.no_road)
+            pole_xyzs[index1],
+            pole_xyzs[index2]]), PathType.no_road)
     # Return graph
     return g
 
@@ -100,8 +109,9 @@ def place_distribution_graph_with_roads(
 
 
 def make_candidate_segment_graph(
-        drop_poles, roads, link_line_maximum_length_in_meters):
-    g = place_distribution_graph_without_roads(drop_poles)
+        drop_poles, roads, link_line_maximum_length_in_meters, graph=None):
+    # Pass graph=CompactGraph() to route with arrays instead of networkx
+    g = place_distribution_graph_without_roads(drop_poles, graph)
     road_geometries = get_geometries(roads)
     # Make paths along link segments
     link_segments = get_link_segments(
@@ -109,17 +119,12 @@ def make_candidate_segment_graph(
     for link_segment in link_segments:
         add_edge_from_line_segment(g, link_segment, PathType.no_road)
     # Make paths connecting drop poles to roads
-    road_segments = get_line_segments(road_geometries)
-    for pole in drop_poles:
-        pole_point = pole.geometry
-        nearest_road_segment = get_nearest_geometry(pole_point, road_segments)
-        path_segment, road_segment1, road_segment2 = get_t_segments(
-            pole_point, nearest_road_segment)
-        road_segments.remove(nearest_road_segment)
-        road_segments.extend([road_segment1, road_segment2])
+    road_segment_store = LineSegmentStore(get_line_segments(road_geometries))
+    for path_segment in road_segment_store.attach_all(get_geometries(
+            drop_poles)):
         add_edge_from_line_segment(g, path_segment, PathType.no_road)
     # Make paths along road segments
-    for road_segment in road_segments:
+    for road_segment in road_segment_store.get_line_segments():
         add_edge_from_line_segment(g, road_segment, PathType.on_road)
     # Return graph
     return g
@@ -137,6 +142,9 @@ def add_edge_from_line_segment(graph, line_segment, path_type):
 def make_candidate_segment_cost_graph(
         candidate_segment_graph, cost_per_meter_by_path_type):
     g = candidate_segment_graph
+    if isinstance(g, CompactGraph):
+        g.set_costs(cost_per_meter_by_path_type)
+        return g
     for index, (point1_xyz, point2_xyz, d) in enumerate(g.edges(data=True)):
         path_type = d['path_type']
         cost_per_meter = cost_per_meter_by_path_type[path_type]
@@ -147,6 +155,21 @@ def make_candidate_segment_cost_graph(
 
 def make_candidate_path_graph(drop_poles, candidate_segment_cost_graph):
     g = nx.Graph()
+    if isinstance(candidate_segment_cost_graph, CompactGraph):
+        # Search once from each pole for the paths to the poles after it
+        pole_xyzs = [_.geometry.coords[0] for _ in drop_poles]
+        for pole1_index, pole1 in enumerate(drop_poles):
+            paths = candidate_segment_cost_graph.get_shortest_paths(
+                pole_xyzs[pole1_index], pole_xyzs[pole1_index + 1:])
+            for pole2, (line_coords, line_cost) in zip(
+                    drop_poles[pole1_index + 1:], paths):
+                g.add_edge(
+                    pole1.id, pole2.id,
+                    id='%s-%s' % (pole1.id, pole2.id),
+                    path_type=None,
+                    geometry=LineString(line_coords),
+                    cost=line_cost)
+        return g
     for pole1, pole2 in combinations(drop_poles, 2):
         pole1_id = pole1.id
         pole2_id = pole2.id
@@ -175,13 +198,33 @@ def make_preferred_segment_graph(
         line_segments = get_line_segments([line_geometry])
         for line_segment in line_segments:
             point1_xyz, point2_xyz = line_segment.coords
-            d = candidate_segment_cost_graph[point1_xyz][point2_xyz]
+            d = candidate_segment_cost_graph.get_edge_data(
+                point1_xyz, point2_xyz)
             d['id'] = 'line%s' % line_index
             line_index += 1
             line_graph.add_edge(point1_xyz, point2_xyz, **d)
     return line_graph
 
 
+def make_steiner_segment_graph(drop_poles, candidate_segment_cost_graph):
+    line_graph = nx.Graph()
+    # Connect drop poles with one multi-source search instead of a
+    # shortest path between every pair
+    pole_xys = [_.geometry.coords[0][:2] for _ in drop_poles]
+    if isinstance(candidate_segment_cost_graph, CompactGraph):
+        tree_edges = candidate_segment_cost_graph.get_steiner_tree_edges(
+            pole_xys)
+    else:
+        tree_edges = get_steiner_tree_edges(
+            candidate_segment_cost_graph, pole_xys, 'cost')
+    for line_index, (point1_xyz, point2_xyz) in enumerate(tree_edges):
+        d = candidate_segment_cost_graph.get_edge_data(
+            point1_xyz, point2_xyz)
+        d['id'] = 'line%s' % line_index
+        line_graph.add_edge(point1_xyz, point2_xyz, **d)
+    return line_graph
+
+
 def place_distribution_poles(
         distribution_graph,
         distribution_pole_maximum_interval_in_meters):
@@ -207,12 +250,13 @@ def place_distribution_poles(
 
 
 def place_batteries(drop_poles, battery_line_maximum_length_in_meters):
-    battery_polygons = get_source_polygons_with_connections(
-        drop_poles, battery_line_maximum_length_in_meters)
+    drop_pole_packs = get_source_polygons_with_connections(
+        drop_poles, battery_line_maximum_length_in_meters)[1]
+    battery_points = place_stores([
+        get_geometries(_) for _ in drop_pole_packs])
     batteries = []
-    for index, battery_polygon in enumerate(battery_polygons):
-        connections = battery_polygon.connections
-        battery_point = place_store(get_geometries(connections))
+    for index, (connections, battery_point) in enumerate(zip(
+            drop_pole_packs, battery_points)):
         battery = Battery(id=index, geometry=battery_point)
         battery.drop_poles = connections
         battery.demand_in_kwh_per_day = estimate_demand_in_kwh_per_day(
@@ -231,75 +275,83 @@ def estimate_demand_in_kwh_per_day(drop_poles):
 
 def choose_lamp_poles(
         poles, customers, lamp_pole_maximum_distance_in_meters):
-    remaining_customers = copy(customers)
-    remaining_poles = copy(poles)
+    """Choose poles greedily by the number of remaining customers they light,
+    then by the sum of distances to those customers, then by pole order"""
+    d = lamp_pole_maximum_distance_in_meters
     lamp_poles = []
-    while remaining_customers:
-        customer_tree = KDTree([(_.x, _.y) for _ in get_geometries(
-            remaining_customers)])
-        pole = choose_next_pole(
-            remaining_poles,
-            customer_tree,
-            lamp_pole_maximum_distance_in_meters)
-        lamp_poles.append(pole)
-        # Remove lamp pole from remaining_poles
-        remaining_poles.remove(pole)
-        # Remove satisfied customers from remaining_customers
-        pole_point = pole.geometry
-        pole_xy = pole_point.x, pole_point.y
-        indices = customer_tree.query_ball_point(
-            pole_xy,
-            lamp_pole_maximum_distance_in_meters)
-        for customer in np.array(remaining_customers)[indices]:
-            remaining_customers.remove(customer)
+    if not poles or not customers:
+        return lamp_poles
+    customer_xys = np.array([(_.x, _.y) for _ in get_geometries(customers)])
+    pole_xys = np.array([(_.x, _.y) for _ in get_geometries(poles)])
+    # Find the customers around each pole once, nearest first
+    coverage_packs = []
+    for pole_xy, customer_indices in zip(pole_xys, KDTree(
+            customer_xys).query_ball_point(pole_xys, d)):
+        customer_indices = np.array(customer_indices, dtype=int)
+        deltas = customer_xys[customer_indices] - pole_xy
+        distances = np.sqrt(deltas[:, 0] ** 2 + deltas[:, 1] ** 2)
+        order = np.argsort(distances, kind='stable')
+        coverage_packs.append((customer_indices[order], distances[order]))
+    # Customers that no pole reaches cannot be lit
+    is_remaining = np.zeros(len(customers), dtype=bool)
+    for customer_indices, distances in coverage_packs:
+        is_remaining[customer_indices] = True
+    remaining_count = is_remaining.sum()
+
+    def get_metric(pole_index):
+        customer_indices, distances = coverage_packs[pole_index]
+        distances = distances[is_remaining[customer_indices]]
+        # Lit customers are those strictly within reach, as with
+        # KDTree.query, but removal takes those on the edge too
+        distances = distances[distances < d]
+        return -len(distances), sum(distances.tolist())
+
+    # Scores only get worse as customers are lit, so a popped pole whose
+    # score is still current beats every other pole
+    heap = [(get_metric(_), _) for _ in range(len(poles))]
+    heapify(heap)
+    while remaining_count and heap:
+        metric, pole_index = heappop(heap)
+        current_metric = get_metric(pole_index)
+        if current_metric != metric:
+            heappush(heap, (current_metric, pole_index))
+            continue
+        lamp_poles.append(poles[pole_index])
+        customer_indices = coverage_packs[pole_index][0]
+        remaining_count -= is_remaining[customer_indices].sum()
+        is_remaining[customer_indices] = False
     for pole in lamp_poles:
         pole.has_street_lamp = True
     return lamp_poles
 
 
-def choose_next_pole(
-        poles, customer_tree, lamp_pole_maximum_distance_in_meters):
-    best_metric = np.inf, np.inf
-    best_pole = None
-    for pole in poles:
-        metric = compute_lamp_pole_metric(
-            pole, customer_tree, lamp_pole_maximum_distance_in_meters)
-        if metric < best_metric:
-            best_metric = metric
-            best_pole = pole
-    return best_pole
-
-
-def compute_lamp_pole_metric(
-        pole, customer_tree, lamp_pole_maximum_distance_in_meters):
-    customer_count = len(customer_tree.data)
-    pole_point = pole.geometry
-    pole_xy = pole_point.x, pole_point.y
-    distances, indices = customer_tree.query(
-        pole_xy,
-        k=customer_count,
-        distance_upper_bound=lamp_pole_maximum_distance_in_meters)
-    if not hasattr(distances, '__iter__'):
-        distances = [distances]
-        indices = [indices]
-    distances = [x for x in distances if x < np.inf]
-    indices = [x for x in indices if x != customer_count]
-    return -len(indices), sum(distances)
-
-
 def choose_panel_poles(
         poles, batteries, distribution_graph,
         solar_pole_minimum_count_per_kwh):
     panel_poles = []
-    pole_tree = KDTree([_.xy for _ in poles])
-    pole_by_xy = {_.xy: _ for _ in poles}
-    for battery in batteries:
-        panel_count = int(ceil(
-            solar_pole_minimum_count_per_kwh * battery.demand_in_kwh_per_day))
-        distance, index = pole_tree.query(battery.xy)
-        battery_pole = poles[index]
-        nearest_poles = get_nearest_poles_on_distribution_graph(
-            battery_pole, pole_by_xy, distribution_graph)
+    pole_xys = [_.xy for _ in poles]
+    pole_tree = KDTree(pole_xys)
+    pole_by_xy = dict(zip(pole_xys, poles))
+    # Find the pole nearest each battery in one query
+    battery_pole_indices = pole_tree.query(
+        [_.xy for _ in batteries])[1] if batteries else []
+    panel_counts = [max(int(ceil(
+        solar_pole_minimum_count_per_kwh * _.demand_in_kwh_per_day,
+    )), 0) for _ in batteries]
+    if isinstance(distribution_graph, CompactGraph):
+        # Rank poles for all batteries in one search
+        nearest_poles_by_battery = [[
+            pole_by_xy[_] for _ in xys] for xys in (
+            distribution_graph.get_nearest_xys([
+                pole_xys[_] for _ in battery_pole_indices], pole_by_xy,
+                panel_counts) if batteries else [])]
+    else:
+        nearest_poles_by_battery = [get_nearest_poles_on_distribution_graph(
+            poles[index], pole_by_xy, distribution_graph,
+            pole_count=panel_count,
+        ) for index, panel_count in zip(battery_pole_indices, panel_counts)]
+    for battery, panel_count, nearest_poles in zip(
+            batteries, panel_counts, nearest_poles_by_battery):
         battery_panel_poles = []
         for pole in nearest_poles:
             if panel_count <= 0:
@@ -313,34 +365,75 @@ def choose_panel_poles(
 
 
 def get_nearest_poles_on_distribution_graph(
-        target_pole, pole_by_xy, distribution_graph):
+        target_pole, pole_by_xy, distribution_graph, pole_count=None):
+    """Rank poles by path cost from target_pole, then by position. Set
+    pole_count to stop searching once that many poles are ranked"""
+    if pole_count == 0:
+        return []
     packs = []
     target_xy = target_pole.xy
-    for source_xy in distribution_graph:
-        path_length = shortest_path_length(
-            distribution_graph, source_xy, target_xy, weight='cost')
-        packs.append((path_length, source_xy))
+    if isinstance(distribution_graph, CompactGraph):
+        return [pole_by_xy[xy] for xy in distribution_graph.get_nearest_xys(
+            [target_xy], pole_by_xy, [
+                len(pole_by_xy) if pole_count is None else pole_count])[0]]
+    # Search outward from the target pole, which ranks nodes in order of
+    # path cost and position, so only ties need sorting afterwards
+    path_length_by_xy = {target_xy: 0}
+    heap = [(0, target_xy)]
+    visited_xys = set()
+    while heap:
+        path_length, xy = heappop(heap)
+        if xy in visited_xys:
+            continue
+        if pole_count is not None and len(packs) >= pole_count and (
+                path_length > packs[pole_count - 1][0]):
+            break
+        visited_xys.add(xy)
+        if xy in pole_by_xy:
+            packs.append((path_length, xy))
+        for neighbor_xy, d in distribution_graph[xy].items():
+            neighbor_path_length = path_length + d['cost']
+            if neighbor_path_length < path_length_by_xy.get(
+                    neighbor_xy, np.inf):
+                path_length_by_xy[neighbor_xy] = neighbor_path_length
+                heappush(heap, (neighbor_path_length, neighbor_xy))
     return [pole_by_xy[xy] for path_length, xy in sorted(
-        packs) if xy in pole_by_xy]
+        packs)][:pole_count]
 
 
 def choose_pole_types(
         poles, distribution_graph, distribution_line_minimum_angle_in_degrees):
-    for pole in poles:
-        pole_xy = pole.xy
-        try:
-            target_xys = list(distribution_graph[pole_xy])
-        except KeyError:
-            print('pole at (%s, %s) is not connected' % pole_xy)
-            continue
-        if len(target_xys) < 2:
-            pole.has_one = True
-            continue
-        for a_xy, c_xy in zip(target_xys, target_xys[1:]):
-            angle = compute_angle(a_xy, pole_xy, c_xy)
-            if angle < distribution_line_minimum_angle_in_degrees:
-                pole.has_angle = True
-                break
+    pole_xys = get_point_xys([_.geometry for _ in poles])
+    if isinstance(distribution_graph, CompactGraph):
+        neighbor_counts, neighbor_xys = distribution_graph.get_neighbor_xys(
+            pole_xys)
+    else:
+        neighbor_counts, neighbor_xys = get_neighbor_xys(
+            distribution_graph, pole_xys)
+    # Measure angles between consecutive neighbors of all poles at once
+    is_missing = neighbor_counts < 0
+    neighbor_counts = np.maximum(neighbor_counts, 0)
+    neighbor_pole_indices = np.repeat(np.arange(len(poles)), neighbor_counts)
+    is_pair = np.ones(len(neighbor_xys), dtype=bool)
+    is_pair[np.cumsum(neighbor_counts)[neighbor_counts > 0] - 1] = False
+    pair_indices = np.flatnonzero(is_pair)
+    pair_pole_indices = neighbor_pole_indices[pair_indices]
+    angles = compute_angle(
+        neighbor_xys[pair_indices],
+        pole_xys[pair_pole_indices],
+        neighbor_xys[pair_indices + 1])
+    has_angles = np.zeros(len(poles), dtype=bool)
+    has_angles[pair_pole_indices[
+        angles < distribution_line_minimum_angle_in_degrees]] = True
+    # Visit only the poles that are missing or flagged
+    for pole_index in np.flatnonzero(is_missing).tolist():
+        print('pole at (%s, %s) is not connected' % tuple(
+            pole_xys[pole_index].tolist()))
+    for pole_index in np.flatnonzero(
+            ~is_missing & (neighbor_counts < 2)).tolist():
+        poles[pole_index].has_one = True
+    for pole_index in np.flatnonzero(has_angles).tolist():
+        poles[pole_index].has_angle = True
     d = defaultdict(list)
     for pole in poles:
         if pole.has_one or pole.has_angle or pole.has_panel:
@@ -352,6 +445,20 @@ def choose_pole_types(
     return dict(d)
 
 
+def get_neighbor_xys(graph, node_xys):
+    """Return the neighbor count of each node, or -1 if it is missing,
+    and the neighbors of all nodes in one array, in networkx order"""
+    # Flatten the adjacency into arrays without a lookup per neighbor;
+    # graph.edges() would lose the order networkx keeps for neighbors
+    neighbor_counts = np.fromiter((len(_) for node_xy, _ in (
+        graph.adjacency())), dtype=int, count=len(graph))
+    neighbor_xys = get_xy_array(chain.from_iterable(
+        _ for node_xy, _ in graph.adjacency()))
+    return gather_neighbor_xys(
+        np.concatenate([[0], np.cumsum(neighbor_counts)]), neighbor_xys,
+        get_xy_indices(get_xy_array(graph), node_xys))
+
+
 def get_pole_angle_points(pole_lines):
     l1 = pole_lines[0].geometry
     l2 = pole_lines[1].geometry
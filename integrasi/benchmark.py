@@ -0,0 +1,176 @@
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import multiprocessing
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+from tabulate import tabulate
+
+from .logs import get_peak_rss
+from .macros import default_options
+from .routines import match_keys
+from .sources import add_kemendagri_key, make_bps_keys, make_kemendagri_province
+
+#benchmark kecepatan dan akurasi pencocokan nama dengan data sintetis, tanpa shapefile asli.
+#jalankan : python -m integrasi.benchmark --ukuran 1000 10000 80000
+
+syllables = ['BA', 'BU', 'CI', 'DA', 'DE', 'GA', 'GU', 'JA', 'JE', 'KA', 'KO', 'LA', 'LE', 'MA', 'ME', 'NA', 'NG', 'PA', 'PU', 'RA', 'RE', 'SA', 'SE', 'SI', 'TA', 'TE', 'WA', 'YA']
+prefixes = ['SUKA', 'MEKAR', 'CI', 'KARANG', 'TANJUNG', 'SUNGAI', 'KAMPUNG', 'GUNUNG', 'SUMBER', 'PASIR', 'BATU', 'TELUK']
+suffixes = ['JAYA', 'MAKMUR', 'SARI', 'WANGI', 'UTARA', 'SELATAN', 'BARAT', 'TIMUR', 'BARU', 'INDAH', 'LESTARI']
+abbreviations = {'TANJUNG': 'TJ.', 'SUNGAI': 'SEI', 'KAMPUNG': 'KP.', 'GUNUNG': 'GN.', 'KARANG': 'KRG', 'PASIR': 'PSR', 'UTARA': 'UTR', 'SELATAN': 'SEL.'}
+
+strategies = {
+    'blok-ngram': {'metode_pencocokan': 'blok', 'mesin_pencocokan': 'ngram'},
+    'blok-ngram-satu-satu': {'metode_pencocokan': 'blok', 'mesin_pencocokan': 'ngram', 'penugasan_satu_satu': True},
+    'blok-difflib': {'metode_pencocokan': 'blok', 'mesin_pencocokan': 'difflib'},
+    'provinsi-ngram': {'metode_pencocokan': 'provinsi', 'mesin_pencocokan': 'ngram'},
+    'provinsi-difflib': {'metode_pencocokan': 'provinsi', 'mesin_pencocokan': 'difflib'},
+}
+
+
+def make_name(rng, used):
+    #nama bergaya Indonesia : [awalan] akar [akhiran], unik dalam satu blok
+    while True:
+        words = [''.join(rng.choice(syllables) for _ in range(rng.randint(2, 3)))]
+        if rng.random() < 0.5 :
+            words.insert(0, rng.choice(prefixes))
+        if rng.random() < 0.3 :
+            words.append(rng.choice(suffixes))
+        name = ' '.join(words)
+        if name not in used :
+            used.add(name)
+            return name
+
+
+def add_typo(rng, name):
+    position = rng.randrange(len(name))
+    kind = rng.choice(['ganti', 'hapus', 'sisip', 'tukar'])
+    if kind == 'ganti' :
+        return name[:position] + rng.choice('ABCDEGHIJKLMNOPRSTUWY') + name[position + 1:]
+    if kind == 'hapus' and len(name) > 3 :
+        return name[:position] + name[position + 1:]
+    if kind == 'tukar' and position < len(name) - 1 :
+        return name[:position] + name[position + 1] + name[position] + name[position + 2:]
+    return name[:position] + name[position] + name[position:]
+
+
+def add_noise(rng, name, typo_rate, spacing_rate, abbreviation_rate):
+    #ejaan BPS : singkatan, spasi yang berbeda dan salah ketik
+    if rng.random() < abbreviation_rate :
+        for word, abbreviation in abbreviations.items():
+            name = name.replace(word, abbreviation)
+    if rng.random() < spacing_rate :
+        if ' ' in name and rng.random() < 0.5 :
+            name = name.replace(' ', '', 1)
+        else :
+            position = rng.randrange(1, len(name))
+            name = name[:position] + ' ' + name[position:]
+    if rng.random() < typo_rate :
+        name = add_typo(rng, name)
+    return name
+
+
+def make_synthetic_province(village_count, seed=0, typo_rate=0.2, spacing_rate=0.2, abbreviation_rate=0.1, missing_rate=0.02):
+    #hasil : (tabel BPS, tabel Kemendagri, kunci Kemendagri yang benar untuk tiap baris BPS atau None)
+    rng = random.Random(seed)
+    kecamatan_count = max(1, village_count // 12)
+    kabupaten_count = max(1, kecamatan_count // 15)
+    kabupaten_names = set()
+    kemendagri_rows = []
+    for kabupaten_index in range(kabupaten_count):
+        kabupaten = make_name(rng, kabupaten_names)
+        kecamatan_names = set()
+        for kecamatan_index in range(kabupaten_index, kecamatan_count, kabupaten_count):
+            kecamatan = make_name(rng, kecamatan_names)
+            desa_names = set()
+            for desa_index in range(kecamatan_index, village_count, kecamatan_count):
+                kemendagri_rows.append(['SINTETIS', kabupaten, kecamatan, make_name(rng, desa_names), len(kemendagri_rows)])
+    kemendagri_frame = add_kemendagri_key(pd.DataFrame(kemendagri_rows, columns=['nama_provinsi', 'nama_kabupaten', 'nama_kecamatan', 'nama_desa', 'kode']))
+
+    bps_rows = []
+    truth = []
+    kemendagri_kept = []
+    for row, key in zip(kemendagri_rows, kemendagri_frame['concatenate']):
+        kabupaten, kecamatan, desa = row[1:4]
+        bps_rows.append([
+            add_noise(rng, kabupaten, typo_rate / 4, spacing_rate, abbreviation_rate),
+            add_noise(rng, kecamatan, typo_rate / 2, spacing_rate, abbreviation_rate),
+            add_noise(rng, desa, typo_rate, spacing_rate, abbreviation_rate)])
+        #sebagian kecil desa BPS tidak punya pasangan di Kemendagri
+        missing = rng.random() < missing_rate
+        kemendagri_kept.append(not missing)
+        truth.append(None if missing else key)
+    order = list(range(len(bps_rows)))
+    rng.shuffle(order)
+    bps_frame = pd.DataFrame([bps_rows[i] for i in order], columns=['KABKOT', 'KECAMATAN', 'DESA'])
+    truth = [truth[i] for i in order]
+    return bps_frame, kemendagri_frame[kemendagri_kept].reset_index(drop=True), truth
+
+
+def score_matches(matches, truth):
+    predicted = [match for match in matches if match is not None and match != "Not Found"]
+    correct = sum(1 for match, key in zip(matches, truth) if key is not None and match == key)
+    precision = correct / len(predicted) if predicted else 0.0
+    recall = correct / sum(1 for key in truth if key is not None)
+    return precision, recall
+
+
+def run_strategy(village_count, seed, strategy):
+    #dijalankan di proses baru supaya memori puncak tiap strategi terpisah, tanpa overhead tracemalloc
+    bps_frame, kemendagri_frame, truth = make_synthetic_province(village_count, seed)
+    options = dict(default_options, file_cache=None, **strategies[strategy])
+    #import yang ditunda di modul matching tidak ikut dihitung waktunya
+    for module_name in ['scipy.optimize', 'scipy.sparse', 'sklearn.feature_extraction.text']:
+        importlib.import_module(module_name)
+    baseline = get_peak_rss()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        bps_keys = make_bps_keys(bps_frame)
+        match_keys(bps_keys, make_kemendagri_province(kemendagri_frame), options)
+    seconds = time.perf_counter() - start
+    peak = get_peak_rss()
+    precision, recall = score_matches(list(bps_keys['concatenate']), truth)
+    return {
+        'strategi': strategy,
+        'desa': village_count,
+        'detik': round(seconds, 3),
+        'baris/detik': round(village_count / seconds, 1),
+        'RSS puncak (MB)': None if peak is None else round(peak, 1),
+        'tambahan (MB)': None if peak is None else round(peak - baseline, 1),
+        'precision': round(precision, 4),
+        'recall': round(recall, 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark kecepatan dan akurasi pencocokan nama desa dengan data sintetis")
+    parser.add_argument('--ukuran', type=int, nargs='+', default=[1000, 10000, 80000], help="Jumlah desa sintetis per provinsi")
+    parser.add_argument('--strategi', nargs='+', choices=sorted(strategies), default=sorted(strategies))
+    parser.add_argument('--maks-difflib-provinsi', type=int, default=1000, help="Lewati provinsi-difflib di atas jumlah desa ini karena waktunya kuadratik")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--file-json', help="Simpan hasil ke file JSON")
+    args = parser.parse_args()
+
+    results = []
+    for village_count in args.ukuran:
+        for strategy in args.strategi:
+            if strategy == 'provinsi-difflib' and village_count > args.maks_difflib_provinsi :
+                print("lewati " + strategy + " untuk " + str(village_count) + " desa")
+                continue
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                result = executor.submit(run_strategy, village_count, args.seed, strategy).result()
+            print(tabulate([result], headers='keys', tablefmt='plain'))
+            results.append(result)
+    print(tabulate(results, headers='keys', tablefmt='psql'))
+    if args.file_json :
+        with open(args.file_json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
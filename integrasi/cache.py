@@ -0,0 +1,73 @@
+import hashlib
+import sqlite3
+import time
+
+
+def fingerprint_block(candidates, options, ngram_source='blok'):
+    #sidik blok kandidat Kemendagri, ikut berubah jika mesin pencocokan atau sumber model n-gram berubah.
+    #ngram_source : 'indeks <id build>' jika vektor n-gram diambil dari indeks Kemendagri, 'blok' jika dilatih pada kandidat blok ini.
+    #id build ikut masuk karena bobot IDF dilatih pada seluruh tabel nasional
+    engine = (options['mesin_pencocokan'], options['rescore_difflib'])
+    if options['mesin_pencocokan'] == 'ngram' :
+        engine += (ngram_source,)
+    fingerprint = hashlib.sha1(repr(engine).encode('utf-8'))
+    for candidate in sorted(candidates):
+        fingerprint.update(candidate.encode('utf-8') + b'\n')
+    return fingerprint.hexdigest()
+
+
+class MatchCache(object):
+    #cache hasil pencocokan di disk, kunci : (nama BPS yang sudah dinormalisasi, sidik blok kandidat)
+
+    def __init__(self, path, maximum_count):
+        self.maximum_count = maximum_count
+        self.hit_count = 0
+        self.miss_count = 0
+        self.connection = sqlite3.connect(path, timeout=600)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS match_cache ('
+            'query TEXT NOT NULL, block TEXT NOT NULL, match TEXT, score REAL, used REAL, '
+            'PRIMARY KEY (query, block))')
+
+    def get(self, queries, block):
+        found = {}
+        queries = list(dict.fromkeys(queries))
+        for start in range(0, len(queries), 500):
+            chunk = queries[start:start + 500]
+            rows = self.connection.execute(
+                'SELECT query, match, score FROM match_cache WHERE block = ? AND query IN (%s)' % ','.join('?' * len(chunk)),
+                [block] + chunk)
+            for query, match, score in rows:
+                found[query] = (match, score)
+        if found :
+            now = time.time()
+            with self.connection:
+                self.connection.executemany(
+                    'UPDATE match_cache SET used = ? WHERE query = ? AND block = ?',
+                    [(now, query, block) for query in found])
+        self.hit_count += len(found)
+        return found
+
+    def put(self, queries, block, matches, scores):
+        now = time.time()
+        self.miss_count += len(queries)
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO match_cache VALUES (?, ?, ?, ?, ?)',
+                [(query, block, match, score, now) for query, match, score in zip(queries, matches, scores)])
+
+    def evict(self):
+        #buang entri yang paling lama tidak dipakai jika jumlahnya melebihi batas
+        with self.connection:
+            return self.connection.execute(
+                'DELETE FROM match_cache WHERE rowid IN ('
+                'SELECT rowid FROM match_cache ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                (self.maximum_count,)).rowcount
+
+    def clear(self):
+        with self.connection:
+            self.connection.execute('DELETE FROM match_cache')
+
+    def close(self):
+        self.connection.close()
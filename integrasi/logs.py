@@ -0,0 +1,80 @@
+import json
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    #Windows : memori puncak tidak diukur
+    resource = None
+
+
+def get_peak_rss():
+    #memori puncak proses sejauh ini dalam MB
+    if resource is None :
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #ru_maxrss dalam KB di Linux, dalam byte di macOS
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours :
+        return '%dj%02dm%02dd' % (hours, minutes, seconds)
+    return '%dm%02dd' % (minutes, seconds)
+
+
+class RunReport(object):
+    #waktu, memori puncak dan jumlah baris tiap tahap, disimpan sebagai JSON
+
+    def __init__(self, name=None):
+        self.name = name
+        self.stages = []
+
+    @contextmanager
+    def stage(self, name, rows=None):
+        #jumlah baris bisa diisi di dalam blok : stage['baris'] = ...
+        entry = {'tahap': name, 'baris': rows}
+        start = time.perf_counter()
+        yield entry
+        entry['detik'] = round(time.perf_counter() - start, 3)
+        peak = get_peak_rss()
+        entry['rss_puncak_mb'] = None if peak is None else round(peak, 1)
+        if entry['baris'] is not None and entry['detik'] > 0 :
+            entry['baris_per_detik'] = round(entry['baris'] / entry['detik'], 1)
+        self.stages.append(entry)
+
+    def progress(self, stage_name, total):
+        label = stage_name if self.name is None else self.name + ' ' + stage_name
+        return ProgressMeter(total, label)
+
+    def to_dict(self):
+        return {'nama': self.name, 'tahap': self.stages}
+
+
+class ProgressMeter(object):
+    #cetak jumlah baris yang selesai, baris/detik dan perkiraan sisa waktu paling sering setiap interval detik
+
+    def __init__(self, total, label, interval=10):
+        self.total = total
+        self.label = label
+        self.interval = interval
+        self.done = 0
+        self.start = self.printed = time.perf_counter()
+
+    def update(self, count):
+        self.done += count
+        now = time.perf_counter()
+        if now - self.printed >= self.interval or self.done >= self.total :
+            self.printed = now
+            rate = self.done / max(now - self.start, 1e-9)
+            remaining = (self.total - self.done) / rate if rate else 0
+            print("%s : %d/%d desa, %.1f desa/detik, sisa ~%s" % (self.label, self.done, self.total, rate, format_duration(remaining)))
+
+
+def write_report(path, report):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, default=str)
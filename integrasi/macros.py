@@ -0,0 +1,55 @@
+#konstanta dan validasi yang dipakai CLI, sengaja tanpa import pandas/geopandas supaya cepat dimuat
+
+indonesia_filename = 'desa_webgis_bps.shp'
+bps_parquet_folder = 'desa_webgis_bps_parquet'
+kemendagri_index_folder = 'kemendagri_index'
+kemendagri_geo_filename = 'indonesia_kem_full.shp'
+kemendagrid_csv = 'kemendagri.csv'
+default_options = {
+    #'blok' : cocokkan KABKOT -> KECAMATAN -> DESA, 'provinsi' : cocokkan dengan seluruh desa di provinsi
+    'metode_pencocokan': 'blok',
+    #'ngram' : cosine similarity n-gram karakter (cepat), 'difflib' : difflib.SequenceMatcher untuk setiap pasangan
+    'mesin_pencocokan': 'ngram',
+    #nilai ulang kandidat n-gram dengan rasio difflib agar kolom similarity sebanding dengan hasil sebelumnya
+    'rescore_difflib': True,
+    #pasangkan desa dalam satu kecamatan satu-satu (linear sum assignment) supaya tidak ada dua desa BPS yang mendapat desa Kemendagri yang sama
+    'penugasan_satu_satu': False,
+    'folder_hasil': '.',
+    #'shp' (kompatibel dengan proses sebelumnya), 'parquet' (GeoParquet) atau 'fgb' (FlatGeobuf)
+    'format_hasil': 'shp',
+    'ukuran_chunk': 20000,
+    #cache hasil pencocokan antar run, None untuk mematikan
+    'file_cache': 'cache_pencocokan.sqlite',
+    'cache_maks': 2000000,
+}
+
+matching_engine_names = ['difflib', 'ngram']
+
+output_formats = {
+    'shp': ('_final.shp', 'ESRI Shapefile'),
+    'fgb': ('_final.fgb', 'FlatGeobuf'),
+    'parquet': ('_final.parquet', None),
+}
+
+province_table = {'id_prov': [11,51,36,17,34,31,75,15,32,33,35,61,63,62,64,65,19,21,18,81,82,52,53,91,92,14,76,73,72,74,71,13,16,12], 
+     'nama_prov': ['ACEH','BALI','BANTEN','BENGKULU','DAERAH ISTIMEWA YOGYAKARTA','DKI JAKARTA','GORONTALO','JAMBI','JAWA BARAT','JAWA TENGAH','JAWA TIMUR','KALIMANTAN BARAT','KALIMANTAN SELATAN','KALIMANTAN TENGAH','KALIMANTAN TIMUR','KALIMANTAN UTARA','KEPULAUAN BANGKA BELITUNG','KEPULAUAN RIAU','LAMPUNG','MALUKU','MALUKU UTARA','NUSA TENGGARA BARAT','NUSA TENGGARA TIMUR','PAPUA BARAT','PAPUA','RIAU','SULAWESI BARAT','SULAWESI SELATAN','SULAWESI TENGAH','SULAWESI TENGGARA','SULAWESI UTARA','SUMATERA BARAT','SUMATERA SELATAN','SUMATERA UTARA',
+]}
+nama_prov_by_id = dict(zip(province_table['id_prov'], province_table['nama_prov']))
+
+
+def validate_id_prov(id_prov):
+    if not id_prov :
+        print("Masukkan ID provinsi")
+        return False
+    nama_prov = nama_prov_by_id.get(id_prov)
+    if nama_prov is None :
+        print("Tidak ada provinsi dengan ID tersebut")
+        return False
+    return nama_prov
+
+
+def get_id_prov_bps(id_prov):
+    #kode provinsi Papua di data BPS adalah 94
+    if id_prov == 92 :
+        return 94
+    return id_prov
@@ -0,0 +1,284 @@
+import difflib
+
+import numpy as np
+import pandas as pd
+
+from .cache import fingerprint_block
+
+
+def similar(a, b):
+    if a is not None and b is not None :
+        return difflib.SequenceMatcher(None, a, b).ratio()
+
+
+def normalize_name(names):
+    return names.replace(r'\s','', regex=True)
+
+
+def normalize_key(names):
+    return normalize_name(names).str.upper()
+
+
+def match_exact(concat_list, kemendagri_concatenate):
+    #hash join kunci yang sudah dinormalisasi (tanpa spasi, huruf besar). hasil NaN jika tidak ada yang sama persis
+    lookup = pd.Series(list(kemendagri_concatenate), index=list(normalize_key(kemendagri_concatenate)))
+    lookup = lookup[~lookup.index.duplicated()]
+    return normalize_key(concat_list).map(lookup)
+
+
+def match_difflib(queries, candidates, cutoff=0.6):
+    #sama dengan difflib.get_close_matches(n=1), tetapi nilai kemiripan ikut dikembalikan
+    matcher = difflib.SequenceMatcher()
+    matches = []
+    scores = []
+    for query in queries:
+        matcher.set_seq2(query)
+        best = None
+        for candidate in candidates:
+            matcher.set_seq1(candidate)
+            if matcher.real_quick_ratio() >= cutoff and matcher.quick_ratio() >= cutoff :
+                score = matcher.ratio()
+                if score >= cutoff and (best is None or (score, candidate) > best):
+                    best = (score, candidate)
+        matches.append(best[1] if best else None)
+        scores.append(best[0] if best else None)
+    return matches, scores
+
+
+def make_ngram_vectorizer(ngram_range=(2, 3)):
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    return TfidfVectorizer(analyzer='char', ngram_range=ngram_range, lowercase=False)
+
+
+def ngram_top_candidates(queries, candidates, top_k=5, batch_cells=5000000, ngram_index=None):
+    #kandidat top-k dari cosine similarity vektor n-gram karakter, dihitung per batch dengan perkalian matriks sparse.
+    #ngram_index : (vectorizer, vektor kandidat, id build indeks) yang sudah dihitung di indeks Kemendagri.
+    #hasil : (indeks kandidat, nilai cosine) untuk tiap query, atau None jika vektor n-gram tidak bisa dibuat
+    if ngram_index is not None :
+        vectorizer, candidate_vectors, build_id = ngram_index
+        candidate_vectors = candidate_vectors.T.tocsc()
+    else :
+        vectorizer = make_ngram_vectorizer()
+        try:
+            candidate_vectors = vectorizer.fit_transform(candidates).T.tocsc()
+        except ValueError:
+            #semua nama kandidat lebih pendek dari n-gram terkecil
+            return None
+    query_vectors = vectorizer.transform(queries)
+    k = min(top_k, len(candidates))
+    batch_size = max(1, batch_cells // len(candidates))
+    top_candidates = []
+    for start in range(0, len(queries), batch_size):
+        cosine = (query_vectors[start:start + batch_size] @ candidate_vectors).toarray()
+        top_indices = np.argpartition(-cosine, k - 1, axis=1)[:, :k]
+        top_candidates.extend(zip(top_indices, np.take_along_axis(cosine, top_indices, axis=1)))
+    return top_candidates
+
+
+def match_ngram(queries, candidates, cutoff=0.6, top_k=5, rescore=True, ngram_index=None):
+    #rescore=True menilai ulang kandidat top-k dengan rasio difflib agar kolom similarity sebanding dengan hasil sebelumnya
+    matches = [None] * len(queries)
+    scores = [None] * len(queries)
+    if not len(queries) or not len(candidates):
+        return matches, scores
+    candidates = list(candidates)
+    top_candidates = ngram_top_candidates(queries, candidates, top_k, ngram_index=ngram_index)
+    if top_candidates is None :
+        return match_difflib(queries, candidates, cutoff)
+    for index, (indices, cosines) in enumerate(top_candidates):
+        if rescore :
+            best = None
+            for candidate_index, cosine in zip(indices, cosines):
+                if cosine <= 0 :
+                    continue
+                candidate = candidates[candidate_index]
+                score = similar(queries[index], candidate)
+                if best is None or (score, candidate) > best:
+                    best = (score, candidate)
+        else :
+            position = np.argmax(cosines)
+            best = (cosines[position], candidates[indices[position]])
+        if best is not None and best[0] >= cutoff :
+            scores[index], matches[index] = best
+    return matches, scores
+
+
+matching_engines = {
+    'difflib': match_difflib,
+    'ngram': match_ngram,
+}
+
+
+def run_engine(queries, candidates, options, ngram_index=None):
+    if options['mesin_pencocokan'] == 'ngram' :
+        return match_ngram(queries, candidates, rescore=options['rescore_difflib'], ngram_index=ngram_index)
+    return matching_engines[options['mesin_pencocokan']](queries, candidates)
+
+
+def score_candidates(queries, candidates, options, cutoff=0.6, top_k=5):
+    #matriks sparse kemiripan query x kandidat, hanya pasangan dengan nilai >= cutoff yang disimpan
+    from scipy.sparse import coo_matrix
+    candidates = list(candidates)
+    top_candidates = None
+    if options['mesin_pencocokan'] == 'ngram' :
+        top_candidates = ngram_top_candidates(queries, candidates, top_k)
+    rows, columns, values = [], [], []
+    for row, query in enumerate(queries):
+        if top_candidates is None :
+            candidate_indices, cosines = range(len(candidates)), None
+        else :
+            candidate_indices, cosines = top_candidates[row]
+        for position, column in enumerate(candidate_indices):
+            if cosines is not None and cosines[position] <= 0 :
+                continue
+            if cosines is not None and not options['rescore_difflib'] :
+                score = cosines[position]
+            else :
+                score = similar(query, candidates[column])
+            if score >= cutoff :
+                rows.append(row)
+                columns.append(column)
+                values.append(score)
+    return coo_matrix((values, (rows, columns)), shape=(len(queries), len(candidates)))
+
+
+def assign_names(queries, candidates, options):
+    #penugasan satu-satu dalam satu blok yang memaksimalkan total kemiripan, tidak ada kandidat yang dipakai dua kali
+    from scipy.optimize import linear_sum_assignment
+    matches = [None] * len(queries)
+    scores = [None] * len(queries)
+    if not len(queries) or not len(candidates):
+        return matches, scores
+    similarity = score_candidates(queries, candidates, options).tocsc()
+    #hanya kandidat yang punya pasangan yang masuk ke matriks penugasan
+    columns = np.unique(similarity.nonzero()[1])
+    if not len(columns):
+        return matches, scores
+    similarity = similarity[:, columns].toarray()
+    rows, positions = linear_sum_assignment(similarity, maximize=True)
+    for row, position in zip(rows, positions):
+        if similarity[row, position] > 0 :
+            matches[row] = candidates[columns[position]]
+            scores[row] = float(similarity[row, position])
+    return matches, scores
+
+
+def match_names(queries, candidates, options, ngram_index=None):
+    cache = options.get('cache')
+    if cache is None :
+        return run_engine(queries, candidates, options, ngram_index)
+    block = fingerprint_block(candidates, options, 'blok' if ngram_index is None else 'indeks ' + ngram_index[2])
+    found = cache.get(queries, block)
+    missing = [query for query in dict.fromkeys(queries) if query not in found]
+    if missing :
+        matches, scores = run_engine(missing, candidates, options, ngram_index)
+        cache.put(missing, block, matches, scores)
+        found.update(zip(missing, zip(matches, scores)))
+    return [found[query][0] for query in queries], [found[query][1] for query in queries]
+
+
+def closest(concat_list, list_kemendagrid_df, options, ngram_index=None):
+    #cari di seluruh desa provinsi
+    queries = [a for a in concat_list if type(a) is str]
+    progress = options.get('progress')
+    if progress is None :
+        found = dict(zip(queries, zip(*match_names(queries, list_kemendagrid_df, options, ngram_index))))
+    else :
+        #dicocokkan per potongan supaya kemajuan bisa dilaporkan
+        found = {}
+        chunk_size = max(2000, len(queries) // 20)
+        for start in range(0, len(queries), chunk_size):
+            chunk = queries[start:start + chunk_size]
+            found.update(zip(chunk, zip(*match_names(chunk, list_kemendagrid_df, options, ngram_index))))
+            progress.update(len(chunk))
+    results = []
+    scores = []
+    for a in concat_list:
+        if type(a) is not str :
+            results.append(None)
+            scores.append(None)
+        elif found[a][0] is None :
+            results.append("Not Found")
+            scores.append(None)
+        else :
+            results.append(found[a][0])
+            scores.append(found[a][1])
+    return results, scores
+
+
+def build_kemendagri_blocks(kabupaten_list, kecamatan_list, desa_list):
+    #kabupaten -> kecamatan -> daftar desa
+    blocks = {}
+    for kabupaten, kecamatan, desa in zip(kabupaten_list, kecamatan_list, desa_list):
+        blocks.setdefault(kabupaten, {}).setdefault(kecamatan, []).append(desa)
+    return blocks
+
+
+def closest_blocked(kabkot_list, kecamatan_list, desa_list, blocks, list_kemendagrid_df, options, ngram_index=None, claimed_keys=()):
+    #cocokkan KABKOT dulu, lalu KECAMATAN di kabupaten tersebut, lalu DESA di kecamatan tersebut.
+    #kembali ke pencarian satu provinsi hanya jika salah satu blok tidak punya kandidat
+    kabkot_list, kecamatan_list, desa_list = list(kabkot_list), list(kecamatan_list), list(desa_list)
+    valid_rows = [i for i in range(len(desa_list)) if type(kabkot_list[i]) is str and type(kecamatan_list[i]) is str and type(desa_list[i]) is str]
+
+    kabkot_names = sorted(set(kabkot_list[i] for i in valid_rows))
+    closest_kabupaten = dict(zip(kabkot_names, match_names(kabkot_names, list(blocks), options)[0]))
+
+    kecamatan_by_kabupaten = {}
+    for i in valid_rows:
+        kabupaten_match = closest_kabupaten[kabkot_list[i]]
+        if kabupaten_match is not None :
+            kecamatan_by_kabupaten.setdefault(kabupaten_match, set()).add(kecamatan_list[i])
+    closest_kecamatan = {}
+    for kabupaten_match, kecamatan_names in kecamatan_by_kabupaten.items():
+        kecamatan_names = sorted(kecamatan_names)
+        kecamatan_matches = match_names(kecamatan_names, list(blocks[kabupaten_match]), options)[0]
+        for kecamatan, kecamatan_match in zip(kecamatan_names, kecamatan_matches):
+            closest_kecamatan[(kabupaten_match, kecamatan)] = kecamatan_match
+
+    rows_by_kecamatan = {}
+    fallback_rows = []
+    for i in valid_rows:
+        kabupaten_match = closest_kabupaten[kabkot_list[i]]
+        kecamatan_match = closest_kecamatan.get((kabupaten_match, kecamatan_list[i]))
+        if kecamatan_match is None :
+            fallback_rows.append(i)
+        else :
+            rows_by_kecamatan.setdefault((kabupaten_match, kecamatan_match), []).append(i)
+
+    results = [None] * len(desa_list)
+    scores = [None] * len(desa_list)
+    progress = options.get('progress')
+    for (kabupaten_match, kecamatan_match), rows in rows_by_kecamatan.items():
+        desa_candidates = blocks[kabupaten_match][kecamatan_match]
+        if options['penugasan_satu_satu'] :
+            #desa Kemendagri yang sudah dipakai pencocokan sama persis tidak ikut dibagi lagi
+            desa_candidates = [desa for desa in desa_candidates if kabupaten_match + kecamatan_match + desa not in claimed_keys]
+            desa_matches = assign_names([desa_list[i] for i in rows], desa_candidates, options)[0]
+        else :
+            desa_matches = match_names([desa_list[i] for i in rows], desa_candidates, options)[0]
+        for i, desa_match in zip(rows, desa_matches):
+            if desa_match is None :
+                fallback_rows.append(i)
+            else :
+                results[i] = kabupaten_match + kecamatan_match + desa_match
+                #nilai kemiripan tetap dihitung untuk nama lengkap, sama seperti pencarian satu provinsi
+                scores[i] = similar(kabkot_list[i] + kecamatan_list[i] + desa_list[i], results[i])
+        if progress is not None :
+            #desa yang jatuh ke pencarian satu provinsi dihitung saat pencarian itu selesai
+            progress.update(sum(1 for desa_match in desa_matches if desa_match is not None))
+
+    fallback_queries = [kabkot_list[i] + kecamatan_list[i] + desa_list[i] for i in fallback_rows]
+    if options['penugasan_satu_satu'] :
+        #sisa desa juga dipasangkan satu-satu, hanya dengan desa Kemendagri yang belum dipakai
+        taken_keys = set(claimed_keys) | set(result for result in results if result is not None)
+        available_keys = [key for key in list_kemendagrid_df if key not in taken_keys]
+        fallback_results, fallback_scores = assign_names(fallback_queries, available_keys, options)
+        fallback_results = ["Not Found" if result is None else result for result in fallback_results]
+        if progress is not None :
+            progress.update(len(fallback_rows))
+    else :
+        fallback_results, fallback_scores = closest(fallback_queries, list_kemendagrid_df, options, ngram_index)
+    for i, result, score in zip(fallback_rows, fallback_results, fallback_scores):
+        results[i] = result
+        scores[i] = score
+    return results, scores, len(fallback_rows)
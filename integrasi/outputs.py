@@ -0,0 +1,79 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from .macros import output_formats
+
+
+inspection_columns = ['FID','IDDESA','KABKOT','KECAMATAN','DESA','concatenate']
+
+
+def get_duplicated_keys(prov_geo, kemendagrid_df_per_prov):
+    #kunci yang muncul lebih dari sekali setelah merge (termasuk concat kosong), sama dengan duplicated(keep=False) pada hasil lengkap
+    kemendagri_counts = kemendagrid_df_per_prov['concatenate'].value_counts()
+    bps_counts = prov_geo['concatenate'].value_counts(dropna=False)
+    final_counts = bps_counts * kemendagri_counts.reindex(bps_counts.index).fillna(1).clip(lower=1)
+    return final_counts[final_counts > 1].index
+
+
+def iter_final_chunks(prov_geo, kemendagrid_df_per_prov, chunk_size):
+    #concat yang tidak null dimerge ke data kemendagri, lalu yang null, masing-masing per chunk
+    notnull = prov_geo['concatenate'].notnull().values
+    template = pd.merge(prov_geo.iloc[:0], kemendagrid_df_per_prov.iloc[:0], on=['concatenate'], how="left")
+    columns = [column for column in template.columns if column != 'cartodb_id']
+    #kolom Kemendagri bisa kosong untuk sebagian baris, jadi tipenya disamakan di semua chunk
+    dtypes = {}
+    for column in kemendagrid_df_per_prov.columns:
+        if column not in prov_geo.columns and column in columns and (pd.api.types.is_integer_dtype(template[column]) or pd.api.types.is_bool_dtype(template[column])) :
+            dtypes[column] = 'float64'
+    for rows, merge in [(np.flatnonzero(notnull), True), (np.flatnonzero(~notnull), False)]:
+        for start in range(0, len(rows), chunk_size):
+            chunk = prov_geo.iloc[rows[start:start + chunk_size]]
+            if merge :
+                chunk = pd.merge(chunk, kemendagrid_df_per_prov, on=['concatenate'], how="left")
+            yield chunk.reindex(columns=columns).astype(dtypes)
+
+
+def merge_kemendagri(prov_geo, kemendagrid_df_per_prov):
+    #hasil gabungan utuh di memori beserta baris yang perlu dicek, untuk pemakaian sebagai library
+    duplicated_keys = get_duplicated_keys(prov_geo, kemendagrid_df_per_prov)
+    chunks = list(iter_final_chunks(prov_geo, kemendagrid_df_per_prov, max(1, len(prov_geo))))
+    if not chunks :
+        chunks = [pd.merge(prov_geo, kemendagrid_df_per_prov, on=['concatenate'], how="left").drop(columns=['cartodb_id'], errors='ignore')]
+    final = pd.concat(chunks, ignore_index=True)
+    return final, final.loc[final['concatenate'].isin(duplicated_keys), [column for column in inspection_columns if column in final.columns]]
+
+
+def write_outputs(prov_geo, kemendagrid_df_per_prov, target_path, output_format='shp', chunk_size=20000):
+    #hasil gabungan ditulis per chunk sehingga tidak pernah ada utuh di memori, csv perlu dicek ditulis pada putaran yang sama
+    suffix, driver = output_formats[output_format]
+    final_path = target_path + suffix
+    inspection_path = target_path + "_perlu_dicek.csv"
+    duplicated_keys = get_duplicated_keys(prov_geo, kemendagrid_df_per_prov)
+    if output_format == 'parquet' :
+        os.makedirs(final_path, exist_ok=True)
+        for filename in os.listdir(final_path):
+            if filename.startswith('part-') :
+                os.remove(os.path.join(final_path, filename))
+
+    final_count = 0
+    need_inspection_chunks = []
+    for chunk_index, chunk in enumerate(iter_final_chunks(prov_geo, kemendagrid_df_per_prov, chunk_size)):
+        chunk.index = range(final_count, final_count + len(chunk))
+        need_inspection = chunk.loc[chunk['concatenate'].isin(duplicated_keys), inspection_columns]
+        need_inspection.to_csv(inspection_path, mode='w' if chunk_index == 0 else 'a', header=chunk_index == 0)
+        need_inspection_chunks.append(need_inspection)
+        if output_format == 'parquet' :
+            chunk.to_parquet(os.path.join(final_path, 'part-%05d.parquet' % chunk_index), index=False)
+        elif chunk_index == 0 :
+            chunk.to_file(final_path, driver=driver)
+        else :
+            chunk.to_file(final_path, driver=driver, mode='a')
+        final_count += len(chunk)
+    if need_inspection_chunks :
+        need_inspection = pd.concat(need_inspection_chunks)
+    else :
+        need_inspection = pd.DataFrame(columns=inspection_columns)
+        need_inspection.to_csv(inspection_path)
+    return final_count, need_inspection
@@ -0,0 +1,237 @@
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from tabulate import tabulate
+
+from .cache import MatchCache
+from .logs import RunReport, write_report
+from .macros import (
+    bps_parquet_folder, default_options, get_id_prov_bps, indonesia_filename,
+    kemendagri_geo_filename, kemendagri_index_folder, kemendagrid_csv,
+    validate_id_prov)
+from .matching import (
+    build_kemendagri_blocks, closest, closest_blocked, match_exact, similar)
+from .outputs import merge_kemendagri, write_outputs
+from .sources import (
+    KemendagriIndex, add_kemendagri_key, bps_key_columns,
+    get_bps_partition_path, make_bps_keys, make_kemendagri_province,
+    read_kemendagri)
+
+
+def match_keys(bps_keys, kemendagri_prov, options, report=None, verbose=True):
+    #isi kolom concatenate dan similarity pada bps_keys, hasil : jumlah desa per tahap pencocokan.
+    #verbose=False : tanpa pesan dan tanpa laporan kemajuan
+    if report is None :
+        report = RunReport()
+    kabkot_bps = bps_keys['kabkot_bps']
+    kecamatan_bps = bps_keys['kecamatan_bps']
+    desa_bps = bps_keys['desa_bps']
+    kemendagrid_df_per_prov = kemendagri_prov['tabel']
+    list_kemendagrid_df = kemendagri_prov['concatenate']
+
+    if verbose :
+        print("Mencocokkan nama desa yang sama persis...")
+    with report.stage('cocok_persis', len(bps_keys)):
+        exact_matches = match_exact(bps_keys['concat_bps'], kemendagrid_df_per_prov['concatenate'])
+        exact_rows = exact_matches.notnull()
+        bps_keys['concatenate'] = exact_matches
+        bps_keys['similarity'] = np.nan
+        bps_keys.loc[exact_rows, 'similarity'] = [1.0 if a == b else similar(a, b) for a, b in zip(bps_keys.loc[exact_rows, 'concat_bps'], exact_matches[exact_rows])]
+    fuzzy_rows = ~exact_rows & bps_keys['concat_bps'].notnull()
+    fallback_count = 0
+
+    if verbose :
+        print("Mencari nama desa yang paling mirip untuk " + str(fuzzy_rows.sum()) + " desa.  Memakan waktu cukup lama.  Jangan dimatikan!!")
+        options = dict(options, progress=report.progress('cocok_mirip', int(fuzzy_rows.sum())))
+    with report.stage('cocok_mirip', int(fuzzy_rows.sum())):
+        if options['metode_pencocokan'] == 'blok' :
+            kemendagri_blocks = build_kemendagri_blocks(kemendagri_prov['kabupaten'], kemendagri_prov['kecamatan'], kemendagri_prov['desa'])
+            fuzzy_matches, fuzzy_scores, fallback_count = closest_blocked(kabkot_bps[fuzzy_rows], kecamatan_bps[fuzzy_rows], desa_bps[fuzzy_rows], kemendagri_blocks, list_kemendagrid_df, options, kemendagri_prov['ngram'], set(exact_matches[exact_rows]))
+        else :
+            fuzzy_matches, fuzzy_scores = closest(bps_keys.loc[fuzzy_rows, 'concat_bps'], list_kemendagrid_df, options, kemendagri_prov['ngram'])
+        bps_keys.loc[fuzzy_rows, 'concatenate'] = fuzzy_matches
+        #skor kosong menjadi NaN supaya kolom similarity tetap float
+        bps_keys.loc[fuzzy_rows, 'similarity'] = np.array(fuzzy_scores, dtype=float)
+
+    not_found_count = (bps_keys['concatenate'] == "Not Found").sum()
+    tier_counts = [['sama persis', exact_rows.sum()]]
+    if options['metode_pencocokan'] == 'blok' :
+        tier_counts.append(['mirip (dalam blok, satu-satu)' if options['penugasan_satu_satu'] else 'mirip (dalam blok)', fuzzy_rows.sum() - fallback_count])
+        tier_counts.append(['mirip (fallback provinsi)', fallback_count - not_found_count])
+    else :
+        tier_counts.append(['mirip (provinsi)', fuzzy_rows.sum() - not_found_count])
+    tier_counts.append(['tidak ditemukan', not_found_count])
+    tier_counts.append(['nama kosong', bps_keys['concatenate'].isnull().sum()])
+    return [[tier, int(count)] for tier, count in tier_counts]
+
+
+def attach_keys(prov_geo, bps_keys):
+    for column in ['concat_bps', 'concatenate', 'similarity']:
+        prov_geo[column] = bps_keys[column].values
+    return prov_geo
+
+
+def match_province(bps_frame, kemendagri_frame, options=None, kemendagri_geo=None):
+    #normalisasi -> cocokkan -> nilai -> gabung untuk satu provinsi tanpa membaca atau menulis file, kecuali cache jika diminta.
+    #bps_frame : kolom KABKOT, KECAMATAN, DESA.  kemendagri_frame : kolom nama_kabupaten, nama_kecamatan, nama_desa.
+    #kemendagri_geo (opsional) : batas desa Kemendagri untuk memilih pasangan desa yang duplikat.
+    #options['file_cache'] (opsional) : file cache hasil pencocokan seperti pada CLI. Berbeda dengan CLI, cache mati jika tidak diisi.
+    #tidak ada yang dicetak.  hasil : (tabel gabungan, baris yang perlu dicek, jumlah desa per tahap pencocokan)
+    options = dict(dict(default_options, file_cache=None), **(options or {}))
+    kemendagri_frame = add_kemendagri_key(kemendagri_frame.copy())
+    kemendagri_prov = make_kemendagri_province(kemendagri_frame)
+    bps_keys = make_bps_keys(bps_frame)
+    if options['file_cache'] :
+        options['cache'] = MatchCache(options['file_cache'], options['cache_maks'])
+    try:
+        tier_counts = match_keys(bps_keys, kemendagri_prov, options, verbose=False)
+    finally:
+        if options.get('cache') is not None :
+            options['cache'].evict()
+            options['cache'].close()
+    prov_geo = attach_keys(bps_frame.copy(), bps_keys)
+    if kemendagri_geo is not None :
+        from .spatial import resolve_duplicates_spatially
+        resolve_duplicates_spatially(prov_geo, kemendagri_geo, set(kemendagri_prov['concatenate']))
+    final, need_inspection = merge_kemendagri(prov_geo, kemendagri_frame)
+    return final, need_inspection, tier_counts
+
+
+def process_province(id_prov, nama_prov, prov_geo, kemendagri_prov, options):
+    #hasil : (ringkasan provinsi, laporan tiap tahap)
+    nama_prov_no_space = re.sub(r'\s','',nama_prov)
+    print("Memproses untuk provinsi " + nama_prov + " dengan ID provinsi "+ str(id_prov) )
+    print("------------------------------------------------------------------------")
+    report = RunReport(nama_prov)
+    if options['file_cache'] :
+        options = dict(options, cache=MatchCache(options['file_cache'], options['cache_maks']))
+
+    print("Menggabung nama KABKOT, KECAMATAN, DAN DESA....")
+    with report.stage('normalisasi') as stage:
+        if isinstance(prov_geo, str) :
+            #partisi parquet hasil --ingest, cukup baca kolom kunci yang sudah dinormalisasi
+            bps_keys = pd.read_parquet(prov_geo, columns=bps_key_columns)
+        else :
+            bps_keys = make_bps_keys(prov_geo)
+        stage['baris'] = len(bps_keys)
+    kemendagrid_df_per_prov = kemendagri_prov['tabel']
+
+    tier_counts = match_keys(bps_keys, kemendagri_prov, options, report)
+    print(tabulate(tier_counts, headers=['tahap', 'jumlah'], tablefmt='psql'))
+    if options.get('cache') is not None :
+        print("cache pencocokan : " + str(options['cache'].hit_count) + " dipakai ulang, " + str(options['cache'].miss_count) + " dihitung")
+        options['cache'].close()
+
+    import geopandas as gp
+    with report.stage('baca_geometri_bps', len(bps_keys)):
+        if isinstance(prov_geo, str) :
+            #geometri dan atribut lain baru dibaca saat hasil akan ditulis
+            prov_geo = gp.read_parquet(prov_geo).drop(columns=['kabkot_bps', 'kecamatan_bps', 'desa_bps'])
+        else :
+            prov_geo = prov_geo.copy()
+        attach_keys(prov_geo, bps_keys)
+
+    if kemendagri_prov.get('geometri') is not None :
+        from .spatial import resolve_duplicates_spatially
+        print("Memilih pasangan desa yang duplikat dengan batas desa Kemendagri...")
+        with report.stage('spasial', len(prov_geo)):
+            resolved_count = resolve_duplicates_spatially(prov_geo, kemendagri_prov['geometri'], set(kemendagri_prov['concatenate']))
+        print("kelompok duplikat yang terselesaikan secara spasial : " + str(resolved_count))
+
+    target_path = os.path.join(options['folder_hasil'], nama_prov_no_space)
+    #merge dan tulis berjalan per chunk, jadi waktunya dicatat sebagai satu tahap
+    with report.stage('gabung_tulis') as stage:
+        final_count, need_inspection = write_outputs(prov_geo, kemendagrid_df_per_prov, target_path, options['format_hasil'], options['ukuran_chunk'])
+        stage['baris'] = final_count
+    print("jumlah data awal : " + str(prov_geo.shape[0]))
+    print("jumlah data akhir : " + str(final_count))
+    if prov_geo.shape[0] == final_count :
+        print("Jumlah data sama")
+    else :
+        print("Jumlah data berbeda, data di bawah perlu dicek kembali : ")
+        print(tabulate(need_inspection, headers='keys', tablefmt='psql'))
+    report_dict = dict(report.to_dict(), id_prov=id_prov, tier=dict((tier, int(count)) for tier, count in tier_counts))
+    return [nama_prov, prov_geo.shape[0], final_count, need_inspection.shape[0]], report_dict
+
+
+def run_provinces(id_prov_list, options, process_count=1, use_spatial=True):
+    #baca data BPS dan Kemendagri sekali, lalu proses setiap provinsi (paralel jika process_count > 1).
+    #laporan JSON tiap tahap ditulis ke folder hasil
+    import geopandas as gp
+    started = time.time()
+    report = RunReport()
+    print("Mempersiapkan data...")
+    use_parquet = os.path.isdir(bps_parquet_folder)
+    if use_parquet :
+        if os.path.isfile(indonesia_filename) and os.path.getmtime(indonesia_filename) > os.path.getmtime(bps_parquet_folder) :
+            print("desa_webgis_bps.shp lebih baru dari " + bps_parquet_folder + ", jalankan ulang dengan --ingest")
+    else :
+        with report.stage('baca_bps') as stage:
+            indo_geo = gp.read_file(indonesia_filename)
+            geo_by_provno = dict(list(indo_geo.groupby('PROVNO')))
+            stage['baris'] = len(indo_geo)
+    with report.stage('baca_kemendagri') as stage:
+        if os.path.isdir(kemendagri_index_folder) :
+            if os.path.isfile(kemendagrid_csv) and os.path.getmtime(kemendagrid_csv) > os.path.getmtime(kemendagri_index_folder) :
+                print("kemendagri.csv lebih baru dari " + kemendagri_index_folder + ", jalankan ulang dengan --build-index")
+            kemendagri_index = KemendagriIndex(kemendagri_index_folder)
+            get_kemendagri_province = kemendagri_index.get_province
+            stage['baris'] = kemendagri_index.row_count
+        else :
+            kemendagrid_df = read_kemendagri(kemendagrid_csv)
+            kemendagri_by_prov = dict(list(kemendagrid_df.groupby('nama_provinsi')))
+            get_kemendagri_province = lambda nama_prov: make_kemendagri_province(kemendagri_by_prov.get(nama_prov, kemendagrid_df.iloc[0:0]))
+            stage['baris'] = len(kemendagrid_df)
+    kemendagri_geo_by_prov = {}
+    if use_spatial and os.path.isfile(kemendagri_geo_filename) :
+        with report.stage('baca_batas_kemendagri') as stage:
+            kemendagri_geo = gp.read_file(kemendagri_geo_filename)
+            kemendagri_geo_by_prov = dict(list(kemendagri_geo.groupby('ID_PROV')))
+            stage['baris'] = len(kemendagri_geo)
+
+    jobs = []
+    for id_prov in id_prov_list:
+        nama_prov = validate_id_prov(id_prov)
+        if use_parquet :
+            #hanya path partisi yang dikirim ke proses, datanya dibaca di sana
+            prov_geo = get_bps_partition_path(bps_parquet_folder, get_id_prov_bps(id_prov))
+            if not os.path.isfile(prov_geo) :
+                print("Tidak ada data BPS untuk provinsi " + nama_prov)
+                continue
+            size = os.path.getsize(prov_geo)
+        else :
+            prov_geo = geo_by_provno.get(str(get_id_prov_bps(id_prov)), indo_geo.iloc[0:0])
+            size = len(prov_geo)
+        kemendagri_prov = get_kemendagri_province(nama_prov)
+        kemendagri_prov['geometri'] = kemendagri_geo_by_prov.get(id_prov)
+        jobs.append((size, (id_prov, nama_prov, prov_geo, kemendagri_prov, options)))
+    #provinsi terbesar dikerjakan lebih dulu supaya beban proses merata
+    jobs = [job for size, job in sorted(jobs, key=lambda x: -x[0])]
+
+    if len(jobs) == 1 or process_count <= 1 :
+        results = [process_province(*job) for job in jobs]
+    else :
+        with ProcessPoolExecutor(max_workers=process_count) as executor:
+            futures = [executor.submit(process_province, *job) for job in jobs]
+            results = [future.result() for future in futures]
+    if options['file_cache'] :
+        cache = MatchCache(options['file_cache'], options['cache_maks'])
+        cache.evict()
+        cache.close()
+
+    summaries = [summary for summary, province_report in results]
+    report_path = os.path.join(options['folder_hasil'], time.strftime('laporan_run_%Y%m%d_%H%M%S.json', time.localtime(started)))
+    write_report(report_path, {
+        'mulai': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(started)),
+        'detik': round(time.time() - started, 3),
+        'jumlah_proses': process_count,
+        'opsi': dict((key, value) for key, value in options.items() if key not in ('cache', 'progress')),
+        'tahap': report.stages,
+        'provinsi': [province_report for summary, province_report in results],
+    })
+    print("laporan run disimpan di " + report_path)
+    return summaries
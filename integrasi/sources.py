@@ -0,0 +1,129 @@
+import hashlib
+import json
+import os
+import pickle
+
+import numpy as np
+import pandas as pd
+
+from .matching import make_ngram_vectorizer, normalize_name
+
+
+bps_key_columns = ['kabkot_bps', 'kecamatan_bps', 'desa_bps', 'concat_bps']
+
+
+def make_bps_keys(prov_geo):
+    bps_keys = pd.DataFrame(index=prov_geo.index)
+    bps_keys['kabkot_bps'] = normalize_name(prov_geo["KABKOT"])
+    bps_keys['kecamatan_bps'] = normalize_name(prov_geo["KECAMATAN"])
+    bps_keys['desa_bps'] = normalize_name(prov_geo["DESA"])
+    bps_keys['concat_bps'] = bps_keys['kabkot_bps'] + bps_keys['kecamatan_bps'] + bps_keys['desa_bps']
+    return bps_keys
+
+
+def get_bps_partition_path(bps_parquet_folder, provno):
+    return os.path.join(bps_parquet_folder, 'PROVNO=' + str(provno), 'data.parquet')
+
+
+def ingest_bps(indonesia_filename, bps_parquet_folder):
+    #tulis ulang shapefile BPS menjadi GeoParquet per provinsi, lengkap dengan kunci nama yang sudah dinormalisasi
+    import geopandas as gp
+    indo_geo = gp.read_file(indonesia_filename)
+    bps_keys = make_bps_keys(indo_geo)
+    for column in bps_key_columns:
+        indo_geo[column] = bps_keys[column]
+    for provno, prov_geo in indo_geo.groupby('PROVNO'):
+        target_path = get_bps_partition_path(bps_parquet_folder, provno)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        prov_geo.to_parquet(target_path, index=False)
+    print("Data BPS disimpan per provinsi di " + bps_parquet_folder)
+
+
+def add_kemendagri_key(kemendagrid_df):
+    kemendagrid_df.loc[:,"concatenate"] = normalize_name(kemendagrid_df["nama_kabupaten"]) + normalize_name(kemendagrid_df["nama_kecamatan"]) + normalize_name(kemendagrid_df["nama_desa"])
+    return kemendagrid_df
+
+
+def read_kemendagri(kemendagrid_csv):
+    return add_kemendagri_key(pd.read_csv(kemendagrid_csv,sep=';')) #kemendagri
+
+
+def make_kemendagri_province(kemendagrid_df_per_prov):
+    return {
+        'tabel': kemendagrid_df_per_prov,
+        'kabupaten': list(normalize_name(kemendagrid_df_per_prov["nama_kabupaten"])),
+        'kecamatan': list(normalize_name(kemendagrid_df_per_prov["nama_kecamatan"])),
+        'desa': list(normalize_name(kemendagrid_df_per_prov["nama_desa"])),
+        'concatenate': list(kemendagrid_df_per_prov["concatenate"]),
+        'ngram': None,
+    }
+
+
+def build_kemendagri_index(kemendagrid_csv, kemendagri_index_folder):
+    #simpan data Kemendagri yang sudah dinormalisasi, diurutkan per provinsi/kabupaten/kecamatan,
+    #sebagai array .npy yang bisa di-memory map beserta vektor n-gram nama lengkapnya
+    kemendagrid_df = read_kemendagri(kemendagrid_csv)
+    kemendagrid_df = kemendagrid_df.sort_values(['nama_provinsi', 'nama_kabupaten', 'nama_kecamatan', 'nama_desa'], kind='stable').reset_index(drop=True)
+    os.makedirs(kemendagri_index_folder, exist_ok=True)
+    #row group kecil supaya pembacaan satu provinsi bisa melewati row group provinsi lain
+    kemendagrid_df.to_parquet(os.path.join(kemendagri_index_folder, 'tabel.parquet'), index=False, row_group_size=10000)
+    province_ranges = {}
+    for nama_prov, rows in kemendagrid_df.groupby('nama_provinsi', sort=False).indices.items():
+        province_ranges[nama_prov] = [int(rows[0]), int(rows[-1]) + 1]
+    with open(os.path.join(kemendagri_index_folder, 'provinsi.json'), 'w') as f:
+        json.dump(province_ranges, f)
+    for name, column in [('kabupaten', 'nama_kabupaten'), ('kecamatan', 'nama_kecamatan'), ('desa', 'nama_desa')]:
+        np.save(os.path.join(kemendagri_index_folder, name + '.npy'), normalize_name(kemendagrid_df[column]).fillna('').values.astype('U'))
+    concatenate = kemendagrid_df['concatenate'].fillna('').values.astype('U')
+    np.save(os.path.join(kemendagri_index_folder, 'concatenate.npy'), concatenate)
+    vectorizer = make_ngram_vectorizer()
+    vectors = vectorizer.fit_transform(concatenate).tocsr()
+    for name in ['data', 'indices', 'indptr']:
+        np.save(os.path.join(kemendagri_index_folder, 'ngram_' + name + '.npy'), getattr(vectors, name))
+    with open(os.path.join(kemendagri_index_folder, 'ngram_vectorizer.pkl'), 'wb') as f:
+        pickle.dump(vectorizer, f)
+    print("Indeks Kemendagri disimpan di " + kemendagri_index_folder)
+
+
+class KemendagriIndex(object):
+    #indeks hasil --build-index, array dibuka dengan memory map dan tabel baru dibaca per provinsi,
+    #sehingga hanya baris provinsi yang dipakai yang dibaca
+
+    def __init__(self, kemendagri_index_folder):
+        self.folder = kemendagri_index_folder
+        with open(os.path.join(kemendagri_index_folder, 'provinsi.json')) as f:
+            self.province_ranges = json.load(f)
+        with open(os.path.join(kemendagri_index_folder, 'ngram_vectorizer.pkl'), 'rb') as f:
+            vectorizer_bytes = f.read()
+        self.vectorizer = pickle.loads(vectorizer_bytes)
+        #id build : berubah setiap --build-index dengan data berbeda, dipakai sebagai bagian kunci cache
+        build_hash = hashlib.sha1(vectorizer_bytes)
+        for name in ['provinsi.json', 'ngram_indptr.npy']:
+            with open(os.path.join(kemendagri_index_folder, name), 'rb') as f:
+                build_hash.update(f.read())
+        self.build_id = build_hash.hexdigest()
+        self.arrays = {}
+        for name in ['kabupaten', 'kecamatan', 'desa', 'concatenate', 'ngram_data', 'ngram_indices', 'ngram_indptr']:
+            self.arrays[name] = np.load(os.path.join(kemendagri_index_folder, name + '.npy'), mmap_mode='r')
+        self.table_path = os.path.join(kemendagri_index_folder, 'tabel.parquet')
+        self.row_count = len(self.arrays['concatenate'])
+
+    def get_province(self, nama_prov):
+        from scipy.sparse import csr_matrix
+        start, end = self.province_ranges.get(nama_prov, [0, 0])
+        indptr = self.arrays['ngram_indptr'][start:end + 1]
+        vectors = csr_matrix((
+            self.arrays['ngram_data'][indptr[0]:indptr[-1]],
+            self.arrays['ngram_indices'][indptr[0]:indptr[-1]],
+            indptr - indptr[0]), shape=(end - start, len(self.vectorizer.vocabulary_)))
+        #tabel sudah diurutkan per provinsi, jadi baris hasil filter sama dengan baris start:end
+        table = pd.read_parquet(self.table_path, filters=[('nama_provinsi', '==', nama_prov)])
+        table.index = pd.RangeIndex(start, start + len(table))
+        return {
+            'tabel': table,
+            'kabupaten': self.arrays['kabupaten'][start:end].tolist(),
+            'kecamatan': self.arrays['kecamatan'][start:end].tolist(),
+            'desa': self.arrays['desa'][start:end].tolist(),
+            'concatenate': self.arrays['concatenate'][start:end].tolist(),
+            'ngram': (self.vectorizer, vectors, self.build_id),
+        }
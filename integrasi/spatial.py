@@ -0,0 +1,68 @@
+import warnings
+
+import numpy as np
+
+from .matching import normalize_name, similar
+
+
+def resolve_duplicates_spatially(prov_geo, kemendagri_geo, kemendagri_keys, minimum_overlap=0.5):
+    #desa BPS yang mendapat concatenate sama dipilih ulang berdasarkan luas irisan dengan poligon desa Kemendagri.
+    #kelompok yang tetap ambigu dibiarkan untuk dicek manual
+    import geopandas as gp
+    concatenate = list(prov_geo['concatenate'])
+    matched = prov_geo['concatenate'].notnull() & (prov_geo['concatenate'] != "Not Found")
+    duplicated = (matched & prov_geo['concatenate'].duplicated(keep=False)).values
+    if not duplicated.any() or kemendagri_geo is None or not len(kemendagri_geo):
+        return 0
+    kemendagri_geo = gp.GeoDataFrame({
+        'concatenate': list(normalize_name(kemendagri_geo['NAMA_KABUP']) + normalize_name(kemendagri_geo['NAMA_KECAM']) + normalize_name(kemendagri_geo['NAMA_DESA'])),
+    }, geometry=kemendagri_geo.geometry.values, crs=kemendagri_geo.crs)
+    kemendagri_geo = kemendagri_geo[kemendagri_geo['concatenate'].isin(kemendagri_keys)]
+    if prov_geo.crs is not None and kemendagri_geo.crs is not None and kemendagri_geo.crs != prov_geo.crs :
+        kemendagri_geo = kemendagri_geo.to_crs(prov_geo.crs)
+    bps_geo = gp.GeoDataFrame({'row': np.flatnonzero(duplicated)}, geometry=prov_geo.geometry.values[duplicated], crs=prov_geo.crs)
+
+    #sjoin memakai indeks spasial STRtree
+    pairs = gp.sjoin(bps_geo, kemendagri_geo, how='inner', predicate='intersects')
+    kemendagri_geometry = gp.GeoSeries(kemendagri_geo.geometry.loc[pairs['index_right']].values, index=pairs.index, crs=kemendagri_geo.crs)
+    with warnings.catch_warnings():
+        #luas dalam derajat cukup untuk perbandingan proporsi irisan
+        warnings.simplefilter('ignore', UserWarning)
+        pairs['overlap'] = (pairs.geometry.intersection(kemendagri_geometry).area / pairs.geometry.area).fillna(0)
+    overlaps = {}
+    for row, key, overlap in zip(pairs['row'], pairs['concatenate'], pairs['overlap']):
+        overlaps[(row, key)] = max(overlap, overlaps.get((row, key), 0))
+    best_keys = {}
+    for (row, key), overlap in overlaps.items():
+        if overlap >= minimum_overlap and overlap > best_keys.get(row, (0, None))[0] :
+            best_keys[row] = (overlap, key)
+
+    rows_by_key = {}
+    for row in np.flatnonzero(duplicated):
+        rows_by_key.setdefault(concatenate[row], []).append(row)
+    claimed_keys = set(prov_geo.loc[matched, 'concatenate'])
+    similarity = list(prov_geo['similarity'])
+    concat_bps = list(prov_geo['concat_bps'])
+    resolved_count = 0
+    for key, rows in rows_by_key.items():
+        #pemilik kunci : desa BPS dengan irisan terbesar terhadap poligon kunci tersebut
+        owner_overlap, owner = max((overlaps.get((row, key), 0), row) for row in rows)
+        if owner_overlap < minimum_overlap :
+            continue
+        new_keys = {}
+        for row in rows:
+            if row == owner :
+                continue
+            best_overlap, best_key = best_keys.get(row, (0, None))
+            if best_key is None or best_key == key or best_key in claimed_keys or best_key in new_keys.values() :
+                break
+            new_keys[row] = best_key
+        else :
+            for row, new_key in new_keys.items():
+                concatenate[row] = new_key
+                similarity[row] = similar(concat_bps[row], new_key)
+            claimed_keys.update(new_keys.values())
+            resolved_count += 1
+    prov_geo['concatenate'] = concatenate
+    prov_geo['similarity'] = np.array(similarity, dtype=float)
+    return resolved_count